@@ -15,50 +15,215 @@
   limitations under the License.
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
-from expiringdict import ExpiringDict
-from graphql import parse, build_ast_schema, MiddlewareManager, Source, validate, execute
+import logging
+from threading import Lock
+
+from agora import Wrapper
+from graphql import parse, build_ast_schema, MiddlewareManager, execute, GraphQLList
+from graphql.error import format_error
 from graphql.execution import ExecutionResult
+from graphql.execution.values import get_variable_values, get_argument_values
+from graphql.language.ast import Field
+from graphql.type.definition import get_nullable_type
+from graphql.utils.get_operation_ast import get_operation_ast
 
-from agora_graphql.gql.executor import AgoraExecutor
+from agora_graphql.gql.abstract import build_type_resolvers
+from agora_graphql.gql.cache import create_resource_cache
+from agora_graphql.gql.cost import CostAnalyzer, QueryCostError, root_limit
+from agora_graphql.gql.data import plans
+from agora_graphql.gql.document import DocumentCache, AgoraBackend, PersistedQueries, execute_document
+from agora_graphql.gql.executor import create_executor, setup_context
+from agora_graphql.gql.fetch import fetcher
+from agora_graphql.gql.loader import failures, flights, set_loader
+from agora_graphql.gql.metrics import timed, timed_iter
 from agora_graphql.gql.middleware import AgoraMiddleware
-from agora_graphql.gql.schema import create_gql_schema
+from agora_graphql.gql.pagination import paginate
+from agora_graphql.gql.projection import Projection, table_projection
+from agora_graphql.gql.response import ResponseCache
+from agora_graphql.gql.schema import SchemaBuilder, build_resolution_table
+from agora_graphql.gql.subtree import SubtreeCache
+from agora_graphql.gql.watcher import SchemaWatcher
+from agora_graphql.misc import fountain_fingerprint
+from agora_graphql.misc.cache import LRUCache
 
 __author__ = 'Fernando Serena'
 
+log = logging.getLogger('agora.gql')
+
+
+class SchemaState(object):
+    """
+    Everything that is bound to one version of the GraphQL schema. Requests take the current state
+    when they start and keep using it until they finish, so a reload never changes it under their feet.
+    """
+    __slots__ = ('source', 'schema', 'documents', 'persisted', 'backend', 'predicates', 'projection',
+                 'type_resolvers')
+
+    def __init__(self, source, schema, documents, persisted, backend, predicates, projection, type_resolvers):
+        self.source = source
+        self.schema = schema
+        self.documents = documents
+        self.persisted = persisted
+        self.backend = backend
+        self.predicates = predicates
+        self.projection = projection
+        self.type_resolvers = type_resolvers
+
 
 class GraphQLProcessor(object):
-    def __init__(self, gateway, schema_path=None, data_gw_cache=None, **kwargs):
+    def __init__(self, gateway, schema_path=None, data_gw_cache=None, document_cache=None, executor='sync',
+                 executor_workers=16, snapshot_path=None, schema_workers=8, watch_interval=None,
+                 persisted_queries=None, response_cache=None, cost=None, fetch=None, load_failures=None,
+                 project_predicates=False, type_cache=None, plan_cache=None, subtree_cache=None,
+                 plan_check_interval=60, **kwargs):
         self.__gateway = gateway
+        fetcher.configure(**(fetch or {}))
+        plans.configure(**(plan_cache or {}))
+        failures.configure(**(load_failures or {}))
+        self.__reload_lock = Lock()
+        fingerprint = fountain_fingerprint(gateway.agora.fountain)
+        plans.bind(fingerprint)
 
+        self.__builder = None
         if schema_path:
             with open(schema_path) as f:
                 source = f.read()
         else:
-            self.__schema_source = create_gql_schema(gateway)
-            source = self.__schema_source
+            self.__builder = SchemaBuilder(gateway, snapshot_path=snapshot_path, workers=schema_workers)
+            source = self.__builder.build(fingerprint)
+
+        if not data_gw_cache:
+            data_gw_cache = {'max_age_seconds': 300, 'max_len': 1000000}
+
+        self.__max_age = data_gw_cache.get('max_age_seconds', 300)
+        self.expiring_dict = create_resource_cache(**data_gw_cache)
+        type_cache = dict(type_cache or {})
+        type_cache.setdefault('max_age_seconds', self.__max_age)
+        type_cache.setdefault('max_len', data_gw_cache.get('max_len', 1000000))
+        self.type_cache = LRUCache(**type_cache)
+
+        self.__subtrees = None
+        if subtree_cache:
+            subtree_cache = dict(subtree_cache)
+            # Subtrees must not outlive the resources they were built from
+            subtree_cache['max_age_seconds'] = min(subtree_cache.get('max_age_seconds', self.__max_age),
+                                                   self.__max_age)
+            self.__subtrees = SubtreeCache(**subtree_cache)
+
+        middleware = AgoraMiddleware(gateway, data_gw_cache=self.expiring_dict, type_cache=self.type_cache,
+                                     subtrees=self.__subtrees, **kwargs)
+        self.__middleware = MiddlewareManager(middleware)
+        self.__analyzer = CostAnalyzer(middleware.cardinality, **(cost or {}))
+
+        self.__executor = create_executor(gateway, executor, max_workers=executor_workers)
+
+        if not document_cache:
+            document_cache = {'max_len': 1000}
+
+        if not persisted_queries:
+            persisted_queries = {'max_len': 10000}
+
+        if response_cache is None:
+            response_cache = {'max_len': 1000}
+
+        self.__responses = None
+        if response_cache:
+            response_cache = dict(response_cache)
+            response_cache.setdefault('max_age_seconds', self.__max_age)
+            self.__responses = ResponseCache(**response_cache)
 
+        self.__document_cache = document_cache
+        self.__project_predicates = project_predicates
+        self.__persisted_queries = persisted_queries
+        self.__state = self.__build_state(source)
+        middleware.predicates = self.__state.predicates
+        middleware.type_resolvers = self.__state.type_resolvers
+
+        self.__watcher = None
+        if watch_interval and self.__builder is not None:
+            self.__watcher = SchemaWatcher(self, interval=watch_interval)
+        elif plan_check_interval:
+            # Plans depend on the fountain even if the schema does not follow it
+            self.__watcher = SchemaWatcher(self, interval=plan_check_interval, plans_only=True)
+
+    def __build_state(self, source):
         document = parse(source)
-        self.__schema = build_ast_schema(document)
-        abstract_types = filter(lambda x: hasattr(x, 'resolve_type'), dict(self.__schema.get_type_map()).values())
+        schema = build_ast_schema(document)
+        abstract_types = filter(lambda x: hasattr(x, 'resolve_type'), dict(schema.get_type_map()).values())
         for at in abstract_types:
             at.resolve_type = self.__resolve_type
 
-        self.__executor = AgoraExecutor(gateway)
+        fountain = Wrapper(self.__gateway.agora.fountain)
+        predicates = build_resolution_table(schema, fountain)
+        documents = DocumentCache(schema, **self.__document_cache)
+        persisted = PersistedQueries(documents, **self.__persisted_queries)
+        projection = table_projection(predicates) if self.__project_predicates else Projection()
+        return SchemaState(source, schema, documents, persisted, AgoraBackend(documents, analyzer=self.__analyzer),
+                           predicates, projection, build_type_resolvers(schema))
 
-        if not data_gw_cache:
-            data_gw_cache = {'max_age_seconds': 300, 'max_len': 1000000}
+    def reload(self):
+        """
+        Checks whether the fountain changed and, if so, regenerates the schema types it affects and swaps
+        the new schema in. Queries already running finish with the schema they started with.
+        :return: True if a new schema was installed
+        """
+        with self.__reload_lock:
+            fingerprint = fountain_fingerprint(self.__gateway.agora.fountain)
+            if self.__builder is None:
+                plans.bind(fingerprint)
+                return False
 
-        self.expiring_dict = ExpiringDict(**data_gw_cache)
-        middleware = AgoraMiddleware(gateway, data_gw_cache=self.expiring_dict, **kwargs)
-        self.__middleware = MiddlewareManager(middleware)
+            if fingerprint == self.__builder.fingerprint:
+                return False
+
+            source = self.__builder.build(fingerprint)
+            state = self.__build_state(source)
+            middleware = self.middleware.middlewares[0]
+            middleware.predicates = state.predicates
+            middleware.type_resolvers = state.type_resolvers
+            middleware.invalidate_types(state.schema, self.__builder.changed_names)
+            plans.bind(fingerprint, types=self.__builder.changed)
+            self.__state = state
+            if self.__responses is not None:
+                self.__responses.clear()
+            if self.__subtrees is not None:
+                self.__subtrees.clear()
+            return True
+
+    def check_fountain(self):
+        """
+        Drops the cached plans if the fountain changed, leaving the schema as is.
+        :return: True if plans were dropped
+        """
+        with self.__reload_lock:
+            fingerprint = fountain_fingerprint(self.__gateway.agora.fountain)
+            if fingerprint == plans.fingerprint:
+                return False
+            plans.bind(fingerprint)
+            return True
+
+    def watch(self):
+        """
+        Makes sure that the schema watcher (if any) is running in the current process.
+        """
+        if self.__watcher is not None:
+            self.__watcher.ensure_running()
 
     def __resolve_type(self, *args, **kwargs):
         m = self.middleware.middlewares[0]
         return m.resolve_type(*args, **kwargs)
 
+    @property
+    def gateway(self):
+        return self.__gateway
+
+    @property
+    def state(self):
+        return self.__state
+
     @property
     def schema_text(self):
-        return self.__schema_source
+        return self.__state.source
 
     @property
     def middleware(self):
@@ -69,38 +234,200 @@ class GraphQLProcessor(object):
         return self.__executor
 
     @property
-    def middleware(self):
-        return self.__middleware
+    def schema(self):
+        return self.__state.schema
 
     @property
-    def schema(self):
-        return self.__schema
+    def documents(self):
+        return self.__state.documents
 
-    def query(self, q):
+    @property
+    def persisted(self):
+        return self.__state.persisted
+
+    @property
+    def analyzer(self):
+        return self.__analyzer
+
+    @property
+    def responses(self):
+        return self.__responses
+
+    @property
+    def subtrees(self):
+        return self.__subtrees
+
+    @property
+    def max_age(self):
+        return self.__max_age
+
+    @property
+    def cache_stats(self):
+        return {
+            'resources': self.expiring_dict.stats,
+            'types': self.type_cache.stats,
+            'documents': self.__state.documents.stats,
+            'persisted': self.__state.persisted.stats,
+            'responses': self.__responses.stats if self.__responses is not None else None,
+            'subtrees': self.__subtrees.stats if self.__subtrees is not None else None,
+            'plans': plans.stats,
+            'fetch': fetcher.stats,
+            'failures': failures.stats,
+            'flights': flights.stats,
+            'cardinality': self.__analyzer.stats
+        }
+
+    @property
+    def backend(self):
+        return self.__state.backend
+
+    def query(self, q, profile=None):
+        self.watch()
+        state = self.__state
         try:
-            source = Source(q, name='GraphQL request')
-            ast = parse(source)
-            validation_errors = validate(self.schema, ast)
-            if validation_errors:
+            document = state.documents.get(q, profile=profile)
+            if document.errors:
                 return ExecutionResult(
-                    errors=validation_errors,
+                    errors=document.errors,
                     invalid=True,
                 )
         except Exception as e:
             return ExecutionResult(errors=[e], invalid=True)
 
+        context = {
+            'query': q,
+            'introspection': document.introspection,
+            'predicates': state.predicates,
+            'projection': state.projection,
+            'type_resolvers': state.type_resolvers,
+            'profile': profile
+        }
+        setup_context(self.__gateway, context)
+        if self.__subtrees is not None:
+            SubtreeCache.track(context)
+
         try:
-            return execute(self.__schema,
-                           ast,
-                           root_value=None,
-                           variable_values={},
-                           operation_name=None,
-                           context_value={
-                               'query': q,
-                               'introspection': 'introspection' in q.lower()
-                           },
-                           middleware=self.__middleware,
-                           executor=self.__executor
-                           )
+            result = execute_document(state.schema,
+                                      document,
+                                      root_value=None,
+                                      variable_values={},
+                                      operation_name=None,
+                                      context_value=context,
+                                      middleware=self.__middleware,
+                                      executor=self.__executor,
+                                      analyzer=self.__analyzer
+                                      )
         except Exception as e:
             return ExecutionResult(errors=[e], invalid=True)
+
+        if self.__subtrees is not None and not result.errors:
+            self.__subtrees.store(context, result.data)
+        return result
+
+    def stream(self, q, variables=None, operation_name=None, profile=None):
+        """
+        Executes a query delivering its root items incrementally: each one is yielded, fully
+        resolved, as soon as its seed comes out of the crawl. Payloads follow @stream: an initial
+        one with an empty root list, one per root item (with its path) and a closing one.
+        Queries that do not select exactly one root list field are delivered in a single payload.
+        If a request profile is given, its timing breakdown is reported in the closing payload.
+        """
+        self.watch()
+        state = self.__state
+        try:
+            document = state.documents.get(q, profile=profile)
+        except Exception as e:
+            errors = [e]
+        else:
+            errors = document.errors
+
+        if errors:
+            yield dict(ExecutionResult(errors=errors, invalid=True).to_dict(), hasNext=False)
+            return
+
+        middleware = self.middleware.middlewares[0]
+        context = {
+            'query': q,
+            'introspection': document.introspection,
+            'predicates': state.predicates,
+            'projection': state.projection,
+            'type_resolvers': state.type_resolvers,
+            'profile': profile
+        }
+        setup_context(self.__gateway, context)
+
+        def run():
+            with timed('execute', profile):
+                return execute(state.schema, document.ast,
+                               root_value=None,
+                               variable_values=variables or {},
+                               operation_name=operation_name,
+                               context_value=context,
+                               middleware=self.__middleware,
+                               executor=self.__executor)
+
+        try:
+            with timed('cost', profile):
+                cost = self.__analyzer.admit(state.schema, document.ast, operation_name=operation_name,
+                                             variables=variables, context=context)
+        except QueryCostError as e:
+            yield dict(ExecutionResult(errors=[e], invalid=True).to_dict(), hasNext=False,
+                       extensions={'cost': e.cost.to_dict()})
+            return
+        extensions = {'cost': cost.to_dict()} if cost is not None else {}
+
+        query_type = state.schema.get_query_type()
+        operation = get_operation_ast(document.ast, operation_name)
+        fields = operation.selection_set.selections if operation is not None else []
+        root = fields[0] if len(fields) == 1 and isinstance(fields[0], Field) else None
+        field_def = query_type.fields.get(root.name.value) if root is not None else None
+        if document.introspection or field_def is None or not isinstance(get_nullable_type(field_def.type),
+                                                                         GraphQLList):
+            result = run()
+            if profile is not None:
+                extensions['profile'] = profile.to_dict()
+            yield dict(result.to_dict(), hasNext=False, extensions=extensions)
+            return
+
+        try:
+            variable_values = get_variable_values(state.schema, operation.variable_definitions or [], variables)
+            args = get_argument_values(field_def.args, root.arguments, variable_values)
+            first, after = args.pop('first', None), args.pop('after', None)
+            dg = middleware.root_graph(operation, profile=profile, **args)
+            seeds = timed_iter(dg.roots, 'seeds', profile)
+            seeds = middleware.cardinality.count(query_type.name, root.name.value, seeds)
+            seeds = paginate(seeds, root_limit(first, context), after)
+        except Exception as e:
+            yield dict(ExecutionResult(errors=[e], invalid=True).to_dict(), hasNext=False)
+            return
+
+        alias = (root.alias or root.name).value
+        set_loader(context, alias, middleware.loader(dg, state.projection))
+        yield {'data': {alias: []}, 'hasNext': True, 'extensions': extensions}
+
+        index = 0
+        closing = {'hasNext': False}
+        try:
+            for seed in seeds:
+                context['seeds'] = [seed]
+                result = run()
+                errors = [format_error(error) for error in result.errors] if result.errors else None
+                items = (result.data or {}).get(alias, None) or []
+                if errors and not items:
+                    yield {'path': [alias, index], 'errors': errors, 'hasNext': True}
+                for item in items:
+                    payload = {'path': [alias, index], 'data': item, 'hasNext': True}
+                    if errors:
+                        payload['errors'] = errors
+                    yield payload
+                    index += 1
+        except Exception as e:
+            # The crawl broke off: say so instead of just ending the stream
+            log.warning(u'Stream interrupted after {} items: {}'.format(index, e))
+            closing['errors'] = [format_error(e)]
+            if hasattr(seeds, 'close'):
+                seeds.close()
+
+        if profile is not None:
+            closing['extensions'] = {'profile': profile.to_dict()}
+        yield closing
@@ -0,0 +1,108 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+from graphql import GraphQLInterfaceType, GraphQLUnionType
+from graphql.language.ast import InlineFragment
+
+from agora_graphql.misc import match
+
+__author__ = 'Fernando Serena'
+
+
+def inline_conditions(field_asts):
+    """
+    Type conditions of the inline fragments directly selected by some field ASTs, in order.
+    """
+    return tuple([s.type_condition.name.value for f in field_asts for s in f.selection_set.selections
+                  if isinstance(s, InlineFragment) and s.type_condition])
+
+
+class InlineConditions(object):
+    """
+    Memo of the inline fragment type conditions of field ASTs. ASTs belong to cached documents, so the same
+    ones come again and again; entries hold them, and the whole memo is dropped when it grows beyond max_len.
+    """
+
+    def __init__(self, max_len=10000):
+        self.max_len = max_len
+        self.__memo = {}
+
+    def get(self, field_asts):
+        key = tuple(field_asts)
+        conditions = self.__memo.get(key, None)
+        if conditions is None:
+            conditions = inline_conditions(field_asts)
+            if len(self.__memo) >= self.max_len:
+                self.__memo.clear()
+            self.__memo[key] = conditions
+        return conditions
+
+
+class AbstractTypeResolver(object):
+    """
+    Resolves the concrete type of items of an interface or union from their rdf:types (in n3).
+    An interface matches the types of its base type (its name without the 'I'); unions match the types
+    of any of their members. Matching items take the first inline fragment type they match, or, if no
+    inline fragments are selected, the base type of the interface (unions need fragments).
+    Names to match are set when the schema is built and decisions are memoized per set of rdf:types and
+    fragment conditions, so resolving an item usually takes a single lookup.
+    """
+
+    def __init__(self, abstract_type, schema, max_len=10000):
+        self.name = abstract_type.name
+        self.max_len = max_len
+        if isinstance(abstract_type, GraphQLInterfaceType):
+            base = abstract_type.name.lstrip('I')
+            self.candidates = (base,)
+            self.default = base if schema.get_type(base) is not None else None
+        else:
+            self.candidates = tuple([t.name for t in abstract_type.types])
+            self.default = None
+        self.__memo = {}
+
+    def __resolve(self, types_n3, conditions):
+        if not any([match(c, types_n3) for c in self.candidates]):
+            return None
+        if not conditions:
+            return self.default
+        for c in conditions:
+            if match(c, types_n3):
+                return c
+
+    def resolve(self, types_n3, conditions=()):
+        """
+        :param types_n3: frozenset of the rdf:types of an item
+        :param conditions: Inline fragment type conditions selected on the field
+        :return: Name of the concrete type of the item, or None
+        """
+        key = types_n3, conditions
+        try:
+            return self.__memo[key]
+        except KeyError:
+            type_name = self.__resolve(types_n3, conditions)
+            if len(self.__memo) >= self.max_len:
+                self.__memo.clear()
+            self.__memo[key] = type_name
+            return type_name
+
+
+def build_type_resolvers(schema):
+    """
+    Type resolvers for all interfaces and unions of a schema, by name.
+    """
+    return {name: AbstractTypeResolver(t, schema) for name, t in schema.get_type_map().items()
+            if isinstance(t, (GraphQLInterfaceType, GraphQLUnionType)) and not name.startswith('__')}
@@ -0,0 +1,203 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import cPickle as pickle
+import logging
+
+from agora_graphql.misc.cache import LRUCache
+
+try:
+    import redis
+except ImportError:
+    # Only the redis backend needs it (agora-graphql[redis])
+    redis = None
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.cache')
+
+
+class ResourceCache(object):
+    """
+    Base of the resource cache backends behind AgoraMiddleware.data_gw_cache.
+    Entries expire max_age_seconds after being set.
+    """
+    backend = None
+
+    def __init__(self, max_age_seconds=300):
+        self.max_age = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def missing(self, keys):
+        """
+        Those of the given keys that are not cached.
+        """
+        return [key for key in keys if key not in self]
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0
+        }
+
+
+class LocalResourceCache(ResourceCache):
+    """
+    Per-process resource cache, bounded both by number of resources and by their estimated size (max_bytes).
+    Least recently used resources are evicted first.
+    """
+    backend = 'local'
+
+    def __init__(self, max_age_seconds=300, max_len=1000000, max_bytes=None):
+        super(LocalResourceCache, self).__init__(max_age_seconds=max_age_seconds)
+        self.__data = LRUCache(max_len=max_len, max_age_seconds=max_age_seconds, max_bytes=max_bytes)
+
+    def _get(self, key):
+        return self.__data.get(key)
+
+    def __setitem__(self, key, value):
+        self.__data[key] = value
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def __len__(self):
+        return len(self.__data)
+
+    @property
+    def stats(self):
+        stats = super(LocalResourceCache, self).stats
+        lru_stats = self.__data.stats
+        for key in ('size', 'max_len', 'evictions', 'bytes', 'max_bytes'):
+            if key in lru_stats:
+                stats[key] = lru_stats[key]
+        return stats
+
+
+class RedisResourceCache(ResourceCache):
+    """
+    Resource cache shared by all worker processes that point to the same Redis database. Resources read
+    from (or written to) Redis are also kept in a small per-process cache for local_max_age_seconds, so
+    that resolving the fields of a resource does not fetch and unpickle it again each time.
+    """
+    backend = 'redis'
+
+    def __init__(self, max_age_seconds=300, redis_host='localhost', redis_port=6379, redis_db=7,
+                 prefix='agora:gql:resource:', max_len=10000, max_bytes=None, local_max_age_seconds=30):
+        if redis is None:
+            raise ImportError('The redis resource cache requires the redis package')
+        super(RedisResourceCache, self).__init__(max_age_seconds=max_age_seconds)
+        self.prefix = prefix
+        self.__r = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+        self.__local = LRUCache(max_len=max_len, max_age_seconds=min(local_max_age_seconds, max_age_seconds),
+                                max_bytes=max_bytes)
+
+    def __key(self, key):
+        return self.prefix + (key.encode('utf-8') if isinstance(key, unicode) else key)
+
+    def _get(self, key):
+        value = self.__local.get(key)
+        if value is not None:
+            return value
+
+        try:
+            data = self.__r.get(self.__key(key))
+        except redis.RedisError as e:
+            log.warning(u'Resource cache unavailable: {}'.format(e))
+            return None
+        if data is None:
+            return None
+        value = self.__local[key] = pickle.loads(data)
+        return value
+
+    def __setitem__(self, key, value):
+        self.__local[key] = value
+        try:
+            self.__r.setex(self.__key(key), int(self.max_age), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except redis.RedisError as e:
+            log.warning(u'Resource cache unavailable: {}'.format(e))
+
+    def __contains__(self, key):
+        if key in self.__local:
+            return True
+        try:
+            return bool(self.__r.exists(self.__key(key)))
+        except redis.RedisError:
+            return False
+
+    def missing(self, keys):
+        """
+        Looks up all the keys that are not local with a single MGET, keeping what it finds locally.
+        """
+        remote = [key for key in keys if key not in self.__local]
+        if not remote:
+            return []
+        try:
+            values = self.__r.mget([self.__key(key) for key in remote])
+        except redis.RedisError as e:
+            log.warning(u'Resource cache unavailable: {}'.format(e))
+            return remote
+
+        missing = []
+        for key, data in zip(remote, values):
+            if data is None:
+                missing.append(key)
+            else:
+                self.__local[key] = pickle.loads(data)
+        return missing
+
+    @property
+    def stats(self):
+        stats = super(RedisResourceCache, self).stats
+        stats['local'] = self.__local.stats
+        return stats
+
+
+def create_resource_cache(backend='local', **kwargs):
+    if backend == 'local':
+        return LocalResourceCache(**kwargs)
+    elif backend == 'redis':
+        return RedisResourceCache(**kwargs)
+    raise ValueError(u'Unknown resource cache backend: {}'.format(backend))
@@ -0,0 +1,227 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+from threading import Lock
+
+from graphql import GraphQLError, GraphQLList, GraphQLScalarType
+from graphql.execution.values import get_variable_values, get_argument_values
+from graphql.language.ast import Field, FragmentSpread, FragmentDefinition
+from graphql.type.definition import get_named_type, get_nullable_type
+from graphql.utils.get_operation_ast import get_operation_ast
+
+__author__ = 'Fernando Serena'
+
+
+class QueryCostError(GraphQLError):
+    def __init__(self, message, cost):
+        super(QueryCostError, self).__init__(message)
+        self.cost = cost
+
+
+class CardinalityStats(object):
+    """
+    Running averages of the number of items that list fields yield, per (type name, field name).
+    Root fields are registered under the name of the query type.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__stats = {}
+
+    def observe(self, type_name, field_name, n):
+        key = (type_name, field_name)
+        with self.__lock:
+            count, mean = self.__stats.get(key, (0, 0.0))
+            count += 1
+            self.__stats[key] = count, mean + (n - mean) / count
+
+    def count(self, type_name, field_name, items):
+        """
+        Passes items through and observes how many there were, if they are consumed to the end.
+        """
+        n = 0
+        for item in items:
+            n += 1
+            yield item
+        self.observe(type_name, field_name, n)
+
+    def mean(self, type_name, field_name, default=None):
+        try:
+            return self.__stats[(type_name, field_name)][1]
+        except KeyError:
+            return default
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return {u'{}.{}'.format(*key): {'observations': count, 'mean': mean} for key, (count, mean) in
+                    self.__stats.items()}
+
+
+class QueryCost(object):
+    __slots__ = ('cost', 'depth', 'root_items', 'item_costs', 'budget', 'root_limit')
+
+    def __init__(self, cost, depth, root_items, item_costs, budget=None):
+        self.cost = cost
+        self.depth = depth
+        self.root_items = root_items
+        self.item_costs = item_costs
+        self.budget = budget
+        self.root_limit = None
+
+    def to_dict(self):
+        cost = {
+            'estimated': int(round(self.cost)),
+            'depth': self.depth,
+            'budget': self.budget
+        }
+        if self.root_limit is not None:
+            cost['rootLimit'] = self.root_limit
+        return cost
+
+
+def root_limit(first, context):
+    """
+    Page size of a root field, given its first argument and the limit imposed by the cost analysis (if any).
+    """
+    limit = context.get('root_limit', None) if isinstance(context, dict) else None
+    if limit is None:
+        return first
+    return limit if first is None else min(first, limit)
+
+
+class CostAnalyzer(object):
+    """
+    Estimates, from the validated AST of a query, how many resources its execution will dereference:
+    every item of a composite field is one dereference and list fields multiply the items of the level
+    below by their first argument, or by their observed (or default) cardinality.
+    Queries deeper than max_depth are rejected. Queries over budget are either rejected (mode 'reject')
+    or downgraded (mode 'truncate') by limiting the number of root items that are crawled.
+    """
+
+    def __init__(self, cardinality=None, budget=None, mode='reject', max_depth=None, default_fan_out=10,
+                 default_roots=100):
+        if mode not in ('reject', 'truncate'):
+            raise ValueError(u'Unknown cost mode: {}'.format(mode))
+        self.cardinality = cardinality if cardinality is not None else CardinalityStats()
+        self.budget = budget
+        self.mode = mode
+        self.max_depth = max_depth
+        self.default_fan_out = default_fan_out
+        self.default_roots = default_roots
+
+    def __fan_out(self, type_name, field_name, args, default):
+        n = self.cardinality.mean(type_name, field_name, default)
+        first = args.get('first', None)
+        return min(first, n) if first is not None else n
+
+    def __fields(self, schema, fragments, parent_type, selection_set):
+        for s in selection_set.selections:
+            if isinstance(s, Field):
+                yield parent_type, s
+            else:
+                fragment = fragments.get(s.name.value) if isinstance(s, FragmentSpread) else s
+                if fragment is None:
+                    continue
+                fragment_type = parent_type
+                if fragment.type_condition:
+                    fragment_type = schema.get_type(fragment.type_condition.name.value)
+                for f in self.__fields(schema, fragments, fragment_type, fragment.selection_set):
+                    yield f
+
+    def __cost(self, schema, fragments, variables, parent_type, selection_set, items, depth):
+        """
+        Estimated dereferences and depth of a selection set over the given number of parent items.
+        """
+        cost = 0.0
+        max_depth = depth
+        for field_type, field in self.__fields(schema, fragments, parent_type, selection_set):
+            field_def = getattr(field_type, 'fields', {}).get(field.name.value, None)
+            if field_def is None or not field.selection_set:
+                continue
+            named_type = get_named_type(field_def.type)
+            if isinstance(named_type, GraphQLScalarType):
+                continue
+
+            field_items = items
+            if isinstance(get_nullable_type(field_def.type), GraphQLList):
+                args = get_argument_values(field_def.args, field.arguments, variables)
+                field_items *= self.__fan_out(field_type.name, field.name.value, args, self.default_fan_out)
+
+            sub_cost, sub_depth = self.__cost(schema, fragments, variables, named_type, field.selection_set,
+                                              field_items, depth + 1)
+            cost += field_items + sub_cost
+            max_depth = max(max_depth, sub_depth)
+        return cost, max_depth
+
+    def estimate(self, schema, document_ast, operation_name=None, variables=None):
+        operation = get_operation_ast(document_ast, operation_name)
+        if operation is None:
+            return None
+
+        fragments = {d.name.value: d for d in document_ast.definitions if isinstance(d, FragmentDefinition)}
+        variables = get_variable_values(schema, operation.variable_definitions or [], variables)
+        query_type = schema.get_query_type()
+
+        cost = 0.0
+        depth = 0
+        root_items = {}
+        item_costs = {}
+        for _, field in self.__fields(schema, fragments, query_type, operation.selection_set):
+            field_def = query_type.fields.get(field.name.value, None)
+            if field_def is None or field.name.value.startswith('__') or not field.selection_set:
+                continue
+            args = get_argument_values(field_def.args, field.arguments, variables)
+            n = self.__fan_out(query_type.name, field.name.value, args, self.default_roots)
+            item_cost, field_depth = self.__cost(schema, fragments, variables, get_named_type(field_def.type),
+                                                 field.selection_set, 1, 1)
+            alias = (field.alias or field.name).value
+            root_items[alias] = n
+            item_costs[alias] = 1 + item_cost
+            cost += n * (1 + item_cost)
+            depth = max(depth, field_depth)
+
+        return QueryCost(cost, depth, root_items, item_costs, budget=self.budget)
+
+    def admit(self, schema, document_ast, operation_name=None, variables=None, context=None):
+        """
+        Estimates the cost of a query and decides whether it can be executed, raising a QueryCostError
+        if not. When truncating, the root page size is set in the context as 'root_limit'.
+        """
+        cost = self.estimate(schema, document_ast, operation_name=operation_name, variables=variables)
+        if cost is None:
+            return None
+
+        if self.max_depth is not None and cost.depth > self.max_depth:
+            raise QueryCostError(u'Query depth {} exceeds the maximum of {}'.format(cost.depth, self.max_depth),
+                                 cost)
+
+        if self.budget is not None and cost.cost > self.budget:
+            per_root_item = sum(cost.item_costs.values())
+            limit = int(self.budget // per_root_item) if per_root_item else 0
+            if self.mode != 'truncate' or limit < 1 or not isinstance(context, dict):
+                raise QueryCostError(
+                    u'Estimated query cost {} exceeds the budget of {}'.format(int(round(cost.cost)), self.budget),
+                    cost)
+            cost.root_limit = limit
+            context['root_limit'] = limit
+
+        return cost
+
+    @property
+    def stats(self):
+        return self.cardinality.stats
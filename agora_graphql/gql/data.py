@@ -16,15 +16,133 @@
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
 
-from agora import Agora, Planner
+import logging
+from threading import Lock
+
 from agora.collector.execution import parse_rdf
-from agora.collector.http import http_get, RDF_MIMES
+from agora.collector.http import http_get
 from rdflib import Graph, ConjunctiveGraph
 
-from agora_graphql.gql.sparql import sparql_from_graphql
+from agora_graphql.gql.fetch import fetcher, rdf_format, LoadError, GONE
+from agora_graphql.gql.metrics import timed
+from agora_graphql.gql.projection import parse_projected
+from agora_graphql.gql.sparql import sparql_from_graphql, query_key
+from agora_graphql.misc import match
+from agora_graphql.misc.cache import LRUCache
 
 __author__ = 'Fernando Serena'
 
+log = logging.getLogger('agora.gql.data')
+
+
+# Rough footprint of a data gateway (proxy, scholar bookkeeping) and of each root of its ecosystem
+DATA_GATEWAY_BYTES = 64 * 1024
+ECOSYSTEM_ROOT_BYTES = 4 * 1024
+
+
+def data_gateway_size(data_gw):
+    """
+    Estimated bytes held by a data gateway: its TED is what grows with the query.
+    """
+    try:
+        roots = len(data_gw.ted.ecosystem.roots)
+    except (AttributeError, TypeError):
+        roots = 0
+    return DATA_GATEWAY_BYTES + roots * ECOSYSTEM_ROOT_BYTES
+
+
+class PlanCache(object):
+    """
+    Process-wide memo of GraphQL to SPARQL translations and of the data gateways
+    (agora plans) built for them. Both are dropped whenever the fountain changes.
+    Data gateways may also be bounded by their estimated size (max_bytes).
+    """
+
+    def __init__(self, max_len=1000, max_age_seconds=300, max_bytes=None):
+        self.__translations = LRUCache(max_len=max_len)
+        self.__gateways = LRUCache(max_len=max_len, max_age_seconds=max_age_seconds, max_bytes=max_bytes,
+                                   sizeof=data_gateway_size)
+        self.fingerprint = None
+
+    def configure(self, max_len=None, max_age_seconds=None, max_bytes=None):
+        """
+        Bounds data gateways differently; the ones cached so far are dropped.
+        """
+        if max_len is None and max_age_seconds is None and max_bytes is None:
+            return
+        gateways = self.__gateways
+        self.__gateways = LRUCache(max_len=max_len or gateways.max_len,
+                                   max_age_seconds=max_age_seconds or gateways.max_age,
+                                   max_bytes=max_bytes if max_bytes is not None else gateways.max_bytes,
+                                   sizeof=data_gateway_size)
+
+    def bind(self, fingerprint, types=None):
+        if fingerprint != self.fingerprint:
+            self.invalidate(types)
+            self.fingerprint = fingerprint
+
+    def invalidate(self, types=None):
+        """
+        Drops the translations whose root fields may refer to any of the given fountain types (all
+        of them if no types are given) and every plan. Translations only depend on the root types,
+        but a plan depends on all the fountain paths that lead to them, through any other type.
+        """
+        self.__gateways.clear()
+        if types is None:
+            self.__translations.clear()
+            return
+
+        for key in self.__translations.keys():
+            root_names = [k[0].split(':')[-1] for k in key[1] if isinstance(k, tuple)]
+            if any([match(name, types) for name in root_names]):
+                self.__translations.pop(key)
+
+    def translate(self, fountain, gql_query, root_mode=True):
+        key = query_key(gql_query, root_mode=root_mode)
+        sparql_query = self.__translations.get(key)
+        if sparql_query is None:
+            sparql_query = sparql_from_graphql(fountain, gql_query, root_mode=root_mode)
+            self.__translations[key] = sparql_query
+        return sparql_query
+
+    def data_gateway(self, gateway, sparql_query, host=None, port=None, base='store'):
+        key = (sparql_query, host, port, base)
+        data_gw = self.__gateways.get(key)
+        if data_gw is None:
+            data_gw = gateway.data(sparql_query, serverless=True, static_fountain=True, host=host, port=port,
+                                   base=base)
+            self.__gateways[key] = data_gw
+        return data_gw
+
+    @property
+    def stats(self):
+        return {
+            'translations': self.__translations.stats,
+            'gateways': self.__gateways.stats
+        }
+
+
+plans = PlanCache()
+
+
+def parse_document(content, format, headers, uri, projection=None):
+    """
+    Parses a fetched document. With a projection, Turtle and N-Triples documents only yield what it
+    keeps about uri; anything else (or a projected parse that fails) is parsed in full.
+    """
+    if projection is not None:
+        try:
+            g = parse_projected(content, format, headers, uri, projection)
+            if g is not None:
+                return g
+        except Exception as e:
+            log.debug(u'Projected parse of {} failed: {}'.format(uri, e))
+        content.seek(0)
+
+    g = ConjunctiveGraph()
+    parse_rdf(g, content, rdf_format(format) or format, headers)
+    return g
+
 
 def roots_gen(gen):
     for c, s, p, o in gen:
@@ -43,20 +161,40 @@ class DataGraph(object):
                                       **self.__kg_params)['generator']
         return roots_gen(gen)
 
+    @property
+    def crawl_key(self):
+        """
+        What the roots of this data graph depend on, or None if its parameters cannot be compared.
+        """
+        key = (self.__data_gw, self.__sparql_query, self.__scholar, self.__follow_cycles,
+               tuple(sorted(self.__kg_params.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     @property
     def loader(self):
-        def wrapper(uri, format):
-            result = self.__data_gw.loader(uri, format)
+        def wrapper(uri, format, projection=None):
+            with timed('load.gateway', self.__profile):
+                result = self.__data_gw.loader(uri, format)
             if result is None and self.__data_gw.loader != http_get:
-                for fmt in sorted(RDF_MIMES.keys(), key=lambda x: x != format):
-                    result = http_get(uri, format=fmt)
-                    if result is not None and not isinstance(result, bool):
-                        content, headers = result
-                        if not isinstance(content, Graph):
-                            g = ConjunctiveGraph()
-                            parse_rdf(g, content, fmt, headers)
-                            result = g, headers
-                        break
+                with timed('load.network', self.__profile):
+                    result = fetcher.get(uri, format=format)
+                if not isinstance(result, tuple):
+                    if result in GONE:
+                        # The resource does not exist (anymore): it is just empty
+                        return ConjunctiveGraph(), {}
+                    raise LoadError.from_outcome(uri, result)
+                content, headers = result
+                if not isinstance(content, Graph):
+                    with timed('load.parse', self.__profile):
+                        try:
+                            g = parse_document(content, format, headers, uri, projection)
+                        except Exception as e:
+                            raise LoadError(u'{} could not be parsed: {}'.format(uri, e))
+                    result = g, headers
             return result
 
         return wrapper
@@ -65,30 +203,18 @@ class DataGraph(object):
         dg = super(DataGraph, cls).__new__(cls)
         dg.__gql_query = args[0]
         dg.__gateway = args[1]
-        dg.__agora = Agora(auto=False)
-        dg.__agora.planner = Planner(dg.__gateway.agora.fountain)
-        dg.__sparql_query = sparql_from_graphql(dg.__agora.fountain, dg.__gql_query, root_mode=True)
-        data_gw_cache = kwargs.get('data_gw_cache', None)
-
-        if data_gw_cache is None or dg.__gql_query not in data_gw_cache:
-            data_gw = dg.__gateway.data(dg.__sparql_query, serverless=True, static_fountain=True,
-                                        host=kwargs.get('host', None), port=kwargs.get('port', None),
-                                        base=kwargs.get('base', 'store'))
-        else:
-            data_gw = data_gw_cache[dg.__gql_query]
+        dg.__profile = kwargs.pop('profile', None)
+        with timed('translate', dg.__profile):
+            dg.__sparql_query = plans.translate(dg.__gateway.agora.fountain, dg.__gql_query, root_mode=True)
+        with timed('plan', dg.__profile):
+            dg.__data_gw = plans.data_gateway(dg.__gateway, dg.__sparql_query,
+                                              host=kwargs.get('host', None), port=kwargs.get('port', None),
+                                              base=kwargs.get('base', 'store'))
 
         if 'server_name' in kwargs:
             del kwargs['server_name']
         if 'port' in kwargs:
             del kwargs['port']
-
-        dg.__data_gw = data_gw
-
-        if data_gw_cache is not None:
-            data_gw_cache[dg.__gql_query] = data_gw
-
-        if 'data_gw_cache' in kwargs:
-            del kwargs['data_gw_cache']
         if 'scholar' in kwargs:
             dg.__scholar = bool(kwargs['scholar'])
             del kwargs['scholar']
@@ -108,3 +234,86 @@ class DataGraph(object):
 
 def data_graph(gql_query, gateway, **kwargs):
     return DataGraph(gql_query, gateway, **kwargs)
+
+
+class SharedCrawl(object):
+    """
+    Roots of a crawl that several consumers iterate from the start, while it only runs once: whoever
+    needs a root that was not produced yet pulls it from the crawl, the rest replay it.
+    """
+
+    def __init__(self, roots):
+        self.__roots = roots
+        self.__items = []
+        self.__lock = Lock()
+        self.__done = False
+        self.__error = None
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self.__items):
+                yield self.__items[i]
+                i += 1
+                continue
+
+            with self.__lock:
+                if i < len(self.__items):
+                    continue
+                if self.__error is not None:
+                    raise self.__error
+                if self.__done:
+                    return
+                try:
+                    self.__items.append(next(self.__roots))
+                except StopIteration:
+                    self.__done = True
+                    return
+                except Exception as e:
+                    self.__error = e
+                    raise
+
+    def close(self):
+        with self.__lock:
+            if not self.__done:
+                self.__done = True
+                self.__roots.close()
+
+
+class CrawlScope(object):
+    """
+    Crawls of a batch of operations: data graphs whose roots depend on the same plan and parameters
+    share a single one, no matter how many root fields of the batch translate to it.
+    """
+
+    def __init__(self):
+        self.__crawls = {}
+        self.__lock = Lock()
+        self.shared = 0
+
+    def roots(self, dg):
+        key = dg.crawl_key
+        if key is None:
+            return dg.roots
+
+        with self.__lock:
+            crawl = self.__crawls.get(key, None)
+            if crawl is None:
+                crawl = self.__crawls[key] = SharedCrawl(dg.roots)
+            else:
+                self.shared += 1
+        return iter(crawl)
+
+    @property
+    def crawls(self):
+        return len(self.__crawls)
+
+    def close(self):
+        """
+        Stops the crawls that are still running once no operation of the batch needs them.
+        """
+        with self.__lock:
+            crawls = self.__crawls.values()
+            self.__crawls = {}
+        for crawl in crawls:
+            crawl.close()
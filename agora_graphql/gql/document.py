@@ -0,0 +1,223 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import re
+from functools import partial
+from hashlib import sha256
+
+from graphql import parse, validate, Source, execute
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+
+from agora_graphql.gql.cost import QueryCostError
+from agora_graphql.gql.metrics import timed
+from agora_graphql.misc.cache import LRUCache
+
+__author__ = 'Fernando Serena'
+
+_tokens = re.compile(r'(?P<block>"""(?:\\"""|[^"]|"(?!""))*""")|'
+                     r'(?P<string>"(?:\\.|[^"\\\n\r])*")|'
+                     r'(?P<ignored>#[^\n\r]*|[\s,]+)|'
+                     r'(?P<punct>\.\.\.|[!$():=@\[\]{}|&])|'
+                     r'(?P<word>[^\s,#"!$():=@\[\]{}|&]+)|'
+                     r'(?P<other>.)', re.UNICODE | re.S)
+
+
+def normalize_query(q):
+    """
+    Canonical form of a GraphQL document text: comments, commas and insignificant
+    whitespace are dropped; string literals (block strings included) and anything
+    else that is not recognized are kept verbatim.
+    """
+    tokens = []
+    prev_word = False
+    for m in _tokens.finditer(q):
+        kind = m.lastgroup
+        if kind == 'ignored':
+            continue
+        word = kind == 'word'
+        if word and prev_word:
+            tokens.append(' ')
+        tokens.append(m.group())
+        prev_word = word
+    return ''.join(tokens)
+
+
+class QueryDocument(object):
+    __slots__ = ('ast', 'errors', 'introspection')
+
+    def __init__(self, ast, errors=None, introspection=False):
+        self.ast = ast
+        self.errors = errors
+        self.introspection = introspection
+
+
+class DocumentCache(object):
+    """
+    Bounded cache of parsed and validated GraphQL documents, keyed by their normalized text.
+    Verbatim repetitions of a text are served without normalizing it again.
+    Documents with validation errors are never cached.
+    """
+
+    def __init__(self, schema, max_len=1000):
+        self.schema = schema
+        self.__cache = LRUCache(max_len=max_len)
+        self.__raw = LRUCache(max_len=max_len)
+
+    def get(self, q, profile=None):
+        document = self.__raw.get(q)
+        if document is not None:
+            return document
+
+        key = normalize_query(q)
+        document = self.__cache.get(key)
+        if document is None:
+            with timed('parse', profile):
+                ast = parse(Source(q, name='GraphQL request'))
+            with timed('validate', profile):
+                errors = validate(self.schema, ast)
+            document = QueryDocument(ast, errors=errors, introspection='introspection' in key.lower())
+            if not errors:
+                self.__cache[key] = document
+        if not document.errors:
+            self.__raw[q] = document
+        return document
+
+    def clear(self):
+        self.__cache.clear()
+        self.__raw.clear()
+
+    @property
+    def stats(self):
+        stats = self.__cache.stats
+        stats['verbatim'] = self.__raw.stats
+        return stats
+
+
+def query_hash(q):
+    if isinstance(q, unicode):
+        q = q.encode('utf-8')
+    return sha256(q).hexdigest()
+
+
+class PersistedQuery(object):
+    __slots__ = ('query', 'document')
+
+    def __init__(self, query, document):
+        self.query = query
+        self.document = document
+
+
+class PersistedQueries(object):
+    """
+    Registry of automatically persisted queries: the SHA-256 hash of a query text gives access to
+    the text and its parsed and validated document. Only valid documents are registered.
+    """
+
+    def __init__(self, documents, max_len=10000):
+        self.documents = documents
+        self.__cache = LRUCache(max_len=max_len)
+
+    def get(self, sha256_hash):
+        return self.__cache.get(sha256_hash.lower())
+
+    def register(self, sha256_hash, q):
+        sha256_hash = sha256_hash.lower()
+        if query_hash(q) != sha256_hash:
+            raise ValueError('Provided sha256Hash does not match the query')
+
+        persisted = PersistedQuery(q, self.documents.get(q))
+        if not persisted.document.errors:
+            self.__cache[sha256_hash] = persisted
+        return persisted
+
+    def clear(self):
+        self.__cache.clear()
+
+    @property
+    def stats(self):
+        return self.__cache.stats
+
+
+def execute_option(options, name, alias):
+    value = options.get(name, None)
+    return value if value is not None else options.get(alias, None)
+
+
+def execute_document(schema, document, *args, **kwargs):
+    """
+    Executes a parsed and validated document, after the (optional) cost analyzer admits it.
+    The cost estimation is reported in the result extensions and, since HTTP views only get to see
+    the formatted result, also under 'extensions' in the context.
+    """
+    analyzer = kwargs.pop('analyzer', None)
+    if document.errors:
+        return ExecutionResult(errors=document.errors, invalid=True)
+
+    extensions = {}
+    profile = None
+    context = execute_option(kwargs, 'context_value', 'context')
+    if isinstance(context, dict):
+        context['extensions'] = extensions
+        profile = context.get('profile', None)
+
+    if analyzer is not None:
+        try:
+            with timed('cost', profile):
+                cost = analyzer.admit(schema, document.ast,
+                                      operation_name=kwargs.get('operation_name', None),
+                                      variables=execute_option(kwargs, 'variable_values', 'variables'),
+                                      context=context)
+        except QueryCostError as e:
+            extensions['cost'] = e.cost.to_dict()
+            return ExecutionResult(errors=[e], invalid=True, extensions=extensions)
+        if cost is not None:
+            extensions['cost'] = cost.to_dict()
+
+    with timed('execute', profile):
+        result = execute(schema, document.ast, *args, **kwargs)
+    if profile is not None:
+        extensions['profile'] = profile.to_dict()
+    result.extensions.update(extensions)
+    return result
+
+
+class AgoraBackend(GraphQLBackend):
+    """
+    GraphQL backend that serves documents from a DocumentCache, so that Flask views
+    share parsing and validation with GraphQLProcessor.query.
+    """
+
+    def __init__(self, documents, analyzer=None, profile=None):
+        self.documents = documents
+        self.analyzer = analyzer
+        self.profile = profile
+
+    def profiled(self, profile):
+        """
+        Same backend, reporting parsing and validation times to the given request profile.
+        """
+        return AgoraBackend(self.documents, analyzer=self.analyzer, profile=profile)
+
+    def document_from_string(self, schema, document_string):
+        document = self.documents.get(document_string, profile=self.profile)
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document.ast,
+            execute=partial(execute_document, schema, document, analyzer=self.analyzer)
+        )
@@ -17,14 +17,38 @@
 """
 
 import traceback
+from threading import local
 
 from agora import Wrapper
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from graphql.execution.executors.sync import SyncExecutor
-from graphql.execution.executors.thread import ThreadExecutor
+from promise import Promise
 from rdflib import ConjunctiveGraph
 
 __author__ = 'Fernando Serena'
 
+def setup_context(gateway, context):
+    """
+    Objects that all resolvers of a request share. Requests set them up before executing; fields
+    only do it for contexts that come without them, and setdefault keeps the first ones set.
+    """
+    if 'fountain' not in context:
+        context.setdefault('fountain', Wrapper(gateway.agora.fountain))
+        context.setdefault('graph', ConjunctiveGraph())
+    return context
+
+
+def setup_field(gateway, info):
+    try:
+        context = info.context
+        # The flag is only ever switched on, so fields resolved concurrently need no lock to update it
+        if not context['introspection'] and (info.field_name.startswith('__') or
+                                             info.parent_type.name.startswith('__')):
+            context['introspection'] = True
+        setup_context(gateway, context)
+    except Exception:
+        traceback.print_exc()
+
 
 class AgoraExecutor(SyncExecutor):
     def __init__(self, gateway):
@@ -32,16 +56,57 @@ class AgoraExecutor(SyncExecutor):
         self.gateway = gateway
 
     def execute(self, fn, *args, **kwargs):
-        info = args[1]
+        setup_field(self.gateway, args[1])
+        return super(AgoraExecutor, self).execute(fn, *args, **kwargs)
 
+
+class ConcurrentAgoraExecutor(object):
+    """
+    Resolves every field in a shared thread pool, so that independent fields and list items
+    are resolved in parallel. Results are chained through promises, hence no request ever
+    waits for a pool thread while holding another one.
+    Promises are not thread-safe, so they are only settled by the thread that runs the query,
+    as soon as the corresponding pool tasks finish.
+    """
+
+    def __init__(self, gateway, max_workers=16):
+        self.gateway = gateway
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.__local = local()
+
+    @property
+    def __pending(self):
         try:
-            info.context['introspection'] = info.context['introspection'] or info.field_name.startswith(
-                '__') or info.parent_type.name.startswith('__')
+            return self.__local.pending
+        except AttributeError:
+            self.__local.pending = {}
+            return self.__local.pending
 
-            if 'fountain' not in info.context:
-                info.context['fountain'] = Wrapper(self.gateway.agora.fountain)
-                info.context['graph'] = ConjunctiveGraph()
+    def wait_until_finished(self):
+        pending = self.__pending
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                promise = pending.pop(future)
+                error, tb = future.exception_info()
+                if error is not None:
+                    promise.do_reject(error, traceback=tb)
+                else:
+                    promise.do_resolve(future.result())
 
-        except Exception as e:
-            traceback.print_exc()
-        return super(AgoraExecutor, self).execute(fn, *args, **kwargs)
+    def clean(self):
+        pass
+
+    def execute(self, fn, *args, **kwargs):
+        setup_field(self.gateway, args[1])
+        promise = Promise()
+        self.__pending[self.__pool.submit(fn, *args, **kwargs)] = promise
+        return promise
+
+
+def create_executor(gateway, mode='sync', max_workers=16):
+    if mode == 'sync':
+        return AgoraExecutor(gateway)
+    elif mode == 'concurrent':
+        return ConcurrentAgoraExecutor(gateway, max_workers=max_workers)
+    raise ValueError(u'Unknown executor mode: {}'.format(mode))
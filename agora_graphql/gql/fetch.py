@@ -0,0 +1,198 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import logging
+import os
+from StringIO import StringIO
+from threading import Lock, BoundedSemaphore
+from urlparse import urlparse
+
+import requests
+from agora.collector.http import RDF_MIMES
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from agora_graphql.misc.cache import LRUCache
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.fetch')
+
+GONE = (404, 410)
+
+
+class LoadError(Exception):
+    """
+    A resource could not be loaded. Only transient errors (timeouts, connection errors and 5xx responses)
+    say something about the health of its host.
+    """
+
+    def __init__(self, message, transient=False):
+        super(LoadError, self).__init__(message)
+        self.transient = transient
+
+    @classmethod
+    def from_outcome(cls, uri, outcome):
+        if outcome is True:
+            return cls(u'{} timed out or could not be reached'.format(uri), transient=True)
+        if outcome is False:
+            return cls(u'{} is not served in any RDF format'.format(uri))
+        return cls(u'{} responded with HTTP {}'.format(uri, outcome), transient=outcome >= 500)
+
+def rdf_format(mime):
+    """
+    Key in RDF_MIMES of a MIME type (or of a format key itself), if any.
+    """
+    if mime in RDF_MIMES:
+        return mime
+    for f, f_mime in RDF_MIMES.items():
+        if mime and f_mime in mime:
+            return f
+
+
+class Fetcher(object):
+    """
+    Dereferences resources over HTTP for the data graphs that fall back to it. Connections are pooled and
+    kept alive, at most max_per_host requests run against the same host at a time, and the RDF format that
+    last worked for each host is remembered, so that later requests negotiate it directly. Until a host's
+    format is known, all formats are requested concurrently and the first one to be served wins.
+    Results are (content, headers), the status of any other response than 200 or 406, True if the request
+    timed out or could not connect, or False if no RDF format is served.
+    """
+
+    def __init__(self, max_per_host=8, pool_size=32, timeout=30, max_hosts=10000):
+        self.max_per_host = max_per_host
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.__formats = LRUCache(max_len=max_hosts)
+        self.__hosts = {}
+        self.__lock = Lock()
+        self.__pid = None
+        self.__session = None
+        self.__pool = None
+        self.requests = 0
+        self.probes = 0
+
+    def configure(self, max_per_host=None, pool_size=None, timeout=None):
+        if max_per_host is None and pool_size is None and timeout is None:
+            return
+        with self.__lock:
+            if max_per_host is not None:
+                self.max_per_host = max_per_host
+                self.__hosts.clear()
+            if pool_size is not None:
+                self.pool_size = pool_size
+            if timeout is not None:
+                self.timeout = timeout
+            # Sessions and probing threads are recreated with the new settings
+            self.__pid = None
+
+    def __ensure(self):
+        """
+        Sessions and threads do not survive forks: each process creates its own on first use.
+        """
+        if self.__pid == os.getpid():
+            return self.__session, self.__pool
+
+        with self.__lock:
+            if self.__pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.__session = session
+                self.__pool = ThreadPoolExecutor(max_workers=max(len(RDF_MIMES), self.pool_size))
+                self.__hosts = {}
+                self.__pid = os.getpid()
+            return self.__session, self.__pool
+
+    def __host_semaphore(self, host):
+        with self.__lock:
+            semaphore = self.__hosts.get(host, None)
+            if semaphore is None:
+                semaphore = self.__hosts[host] = BoundedSemaphore(self.max_per_host)
+            return semaphore
+
+    def __get(self, session, uri, host, format):
+        log.debug(u'HTTP GET {} ({})'.format(uri, format))
+        with self.__host_semaphore(host):
+            self.requests += 1
+            try:
+                response = session.get(uri, headers={'Accept': RDF_MIMES[format]}, timeout=self.timeout)
+            except requests.Timeout:
+                log.debug(u'[Dereference][TIMEOUT][GET] {}'.format(uri))
+                return True
+            except Exception:
+                log.debug(u'[Dereference][ERROR][GET] {}'.format(uri))
+                return True
+
+        if response.status_code == 200:
+            served = rdf_format(response.headers.get('Content-Type', None)) or format
+            return served, (StringIO(response.content), response.headers)
+        if response.status_code == 406:
+            return False
+        return response.status_code
+
+    def __probe(self, session, pool, uri, host, formats):
+        self.probes += 1
+        futures = [pool.submit(self.__get, session, uri, host, f) for f in formats]
+        result = False
+        for future in as_completed(futures):
+            outcome = future.result()
+            if isinstance(outcome, tuple):
+                return outcome
+            # Statuses tell more than connection errors, and these more than unserved formats
+            if outcome is not False and isinstance(result, bool):
+                result = outcome
+        return result
+
+    def get(self, uri, format=None):
+        session, pool = self.__ensure()
+        host = urlparse(uri).netloc
+        formats = sorted(RDF_MIMES.keys(), key=lambda f: f != rdf_format(format))
+
+        known = self.__formats.get(host)
+        if known is not None:
+            outcome = self.__get(session, uri, host, known)
+            if outcome is not False:
+                return outcome[1] if isinstance(outcome, tuple) else outcome
+            # The host stopped serving the format it used to: probe again
+            self.__formats.pop(host)
+            formats.remove(known)
+
+        if not formats:
+            return False
+
+        if len(formats) > 1:
+            outcome = self.__probe(session, pool, uri, host, formats)
+        else:
+            outcome = self.__get(session, uri, host, formats[0])
+        if isinstance(outcome, tuple):
+            served, result = outcome
+            self.__formats[host] = served
+            return result
+        return outcome
+
+    @property
+    def stats(self):
+        stats = self.__formats.stats
+        stats['requests'] = self.requests
+        stats['probes'] = self.probes
+        return stats
+
+
+fetcher = Fetcher()
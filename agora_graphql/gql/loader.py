@@ -0,0 +1,309 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import logging
+from functools import partial
+from threading import Lock, Event
+from time import time
+from urlparse import urlparse
+
+from concurrent.futures import ThreadPoolExecutor
+from rdflib import URIRef
+
+from agora_graphql.gql.fetch import LoadError
+from agora_graphql.gql.metrics import timed
+from agora_graphql.gql.resource import ingest, Resource
+from agora_graphql.misc.cache import LRUCache
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.loader')
+
+
+class HostHealth(object):
+    __slots__ = ('failures', 'consecutive', 'short_circuits', 'opened', 'trial')
+
+    def __init__(self):
+        self.failures = 0
+        self.consecutive = 0
+        self.short_circuits = 0
+        self.opened = None
+        self.trial = False
+
+
+class LoadFailures(object):
+    """
+    Keeps resources that failed to load apart from (possibly empty) loaded ones: failures are remembered
+    for a short negative TTL only. Hosts that fail 'threshold' times in a row get their circuit opened:
+    loads from them are short-circuited for 'cooldown' seconds, after which a single trial load decides
+    whether it closes again.
+    """
+
+    def __init__(self, negative_ttl=30, threshold=5, cooldown=30, max_len=10000):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.__negative = LRUCache(max_len=max_len, max_age_seconds=negative_ttl)
+        self.__hosts = {}
+        self.__lock = Lock()
+
+    def configure(self, negative_ttl=None, threshold=None, cooldown=None, max_len=None):
+        if threshold is not None:
+            self.threshold = threshold
+        if cooldown is not None:
+            self.cooldown = cooldown
+        if negative_ttl is not None or max_len is not None:
+            self.__negative = LRUCache(max_len=max_len or self.__negative.max_len,
+                                       max_age_seconds=negative_ttl or self.__negative.max_age)
+
+    def get(self, key):
+        return self.__negative.get(key)
+
+    def failed(self, key):
+        return key in self.__negative
+
+    def allow(self, host):
+        with self.__lock:
+            health = self.__hosts.get(host, None)
+            if health is None or health.opened is None:
+                return True
+            if not health.trial and time() - health.opened >= self.cooldown:
+                health.trial = True
+                return True
+            health.short_circuits += 1
+            return False
+
+    def success(self, host):
+        with self.__lock:
+            health = self.__hosts.get(host, None)
+            if health is not None:
+                health.consecutive = 0
+                health.opened = None
+                health.trial = False
+
+    def remember(self, resource):
+        self.__negative[resource.uri] = resource
+
+    def failure(self, host, resource):
+        self.remember(resource)
+        with self.__lock:
+            health = self.__hosts.get(host, None)
+            if health is None:
+                health = self.__hosts[host] = HostHealth()
+            health.failures += 1
+            health.consecutive += 1
+            if health.trial or health.consecutive >= self.threshold:
+                if health.opened is None or health.trial:
+                    log.warning(u'Opening circuit for {} after {} consecutive failures'.format(
+                        host, health.consecutive))
+                health.opened = time()
+                health.trial = False
+
+    def clear(self):
+        self.__negative.clear()
+        with self.__lock:
+            self.__hosts.clear()
+
+    @property
+    def hosts(self):
+        with self.__lock:
+            return {host: {
+                'failures': health.failures,
+                'consecutive': health.consecutive,
+                'short_circuits': health.short_circuits,
+                'open': health.opened is not None
+            } for host, health in self.__hosts.items()}
+
+    @property
+    def stats(self):
+        return {
+            'negative': self.__negative.stats,
+            'hosts': self.hosts
+        }
+
+
+failures = LoadFailures()
+
+
+def set_loader(context, root, load_fn):
+    """
+    Makes resources under a root field load through the data graph of that root: sibling root fields
+    may be resolved concurrently, each one with a plan of its own.
+    """
+    context.setdefault('load_fns', {})[root] = load_fn
+
+
+def load_resource(info, uri):
+    """
+    :return: The graph of a resource (None if it could not be loaded) and whether the failure to load it
+    was transient
+    """
+    uri = URIRef(uri)
+    try:
+        log.debug(u'Pulling {}'.format(uri))
+        g, headers = info.context['load_fns'][info.path[0]](uri)
+        return g, False
+    except LoadError as e:
+        log.debug(u'Could not load {}: {}'.format(uri, e))
+        return None, e.transient
+    except Exception as e:
+        log.debug(u'Could not load {}: {}'.format(uri, e))
+        return None, True
+
+
+def resource_key(elm):
+    return elm.toPython() if not isinstance(elm, basestring) else elm
+
+
+class Flight(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Process-wide coalescing of concurrent calls for the same key: the first caller runs the call and every
+    other caller that comes while it runs waits for (and shares) its result. Calls are forgotten as soon as
+    they finish, so later callers are expected to find their result in some cache instead.
+    """
+
+    def __init__(self):
+        self.__flights = {}
+        self.__lock = Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.__lock:
+            flight = self.__flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+            flight.done.set()
+
+    @property
+    def stats(self):
+        with self.__lock:
+            in_flight = len(self.__flights)
+        return {
+            'in_flight': in_flight,
+            'calls': self.calls,
+            'coalesced': self.coalesced
+        }
+
+
+flights = SingleFlight()
+
+
+def cached_resource(cache, info, elm_key):
+    resource = cache.get(elm_key)
+    if resource is not None and resource.projection is not None:
+        projection = info.context.get('projection', None)
+        if projection is None or not projection.covers(resource.projection):
+            # Indexed from a projection that may lack predicates that are needed now
+            resource = None
+    if resource is None:
+        resource = failures.get(elm_key)
+        if resource is not None:
+            info.context['degraded'] = True
+    return resource
+
+
+def fetch_resource(cache, info, elm, elm_key):
+    resource = cached_resource(cache, info, elm_key)
+    if resource is not None:
+        return resource
+
+    host = urlparse(elm_key).netloc
+    if not failures.allow(host):
+        info.context['degraded'] = True
+        resource = Resource(elm_key)
+        failures.remember(resource)
+        return resource
+
+    g, transient = load_resource(info, elm)
+    if g is None:
+        info.context['degraded'] = True
+        resource = Resource(elm_key)
+        if transient:
+            failures.failure(host, resource)
+        else:
+            # The host answered: only the resource is remembered as failed
+            failures.success(host)
+            failures.remember(resource)
+    else:
+        failures.success(host)
+        projection = getattr(g, 'projection', None)
+        with timed('load.index', info.context.get('profile', None)):
+            resource = ingest(g, elm_key, projection=projection.digest if projection else None)
+        cache[elm_key] = resource
+    return resource
+
+
+def get_resource(cache, info, elm):
+    elm_key = resource_key(elm)
+    resource = cached_resource(cache, info, elm_key)
+    if resource is None:
+        # Requests with different projections may not share what they load
+        projection = info.context.get('projection', None)
+        flight_key = elm_key, projection.digest if projection is not None else None
+        resource = flights.do(flight_key, partial(fetch_resource, cache, info, elm, elm_key))
+        if failures.failed(elm_key):
+            info.context['degraded'] = True
+    return resource
+
+
+class BatchLoader(object):
+    """
+    Dereferences batches of resources concurrently (at most fan_out at a time) into a resource cache.
+    """
+
+    def __init__(self, cache, fan_out=8):
+        self.cache = cache
+        self.fan_out = fan_out
+        self.__pool = ThreadPoolExecutor(max_workers=fan_out)
+
+    def load(self, info, elms):
+        keys = {resource_key(e): e for e in elms}
+        pending = set([keys[key] for key in self.cache.missing(keys.keys())])
+        if len(pending) == 1:
+            get_resource(self.cache, info, pending.pop())
+        elif pending:
+            log.debug(u'Pulling a batch of {} resources'.format(len(pending)))
+            list(self.__pool.map(partial(get_resource, self.cache, info), pending))
@@ -0,0 +1,282 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, local, current_thread
+from time import time
+
+__author__ = 'Fernando Serena'
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values (seconds), in the Prometheus sense.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(list(other.counts)):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+
+def label_str(labels):
+    def escape(value):
+        return unicode(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return u','.join([u'{}="{}"'.format(k, escape(v)) for k, v in labels])
+
+
+class MetricsRegistry(object):
+    """
+    Process-wide registry of labelled histograms, rendered in the Prometheus text exposition format.
+    Every thread observes into histograms of its own, so that observing takes no lock; they are only
+    merged when rendered. Those of threads that are gone are folded into a single set.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__shards = []
+        self.__retired = {}
+        self.__local = local()
+        self.__help = {}
+
+    def describe(self, name, help):
+        self.__help[name] = help
+
+    @staticmethod
+    def __fold(histograms, shard):
+        for name, family in shard.items():
+            merged_family = histograms.setdefault(name, {})
+            for key, histogram in family.items():
+                merged = merged_family.get(key, None)
+                if merged is None:
+                    merged = merged_family[key] = Histogram(histogram.buckets)
+                merged.merge(histogram)
+
+    def __retire(self):
+        """
+        Folds the histograms of finished threads (e.g. of per-request pools) away. Call with the lock held.
+        """
+        alive = []
+        for thread, shard in self.__shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.__fold(self.__retired, shard)
+        self.__shards = alive
+
+    def __shard(self):
+        try:
+            return self.__local.histograms
+        except AttributeError:
+            histograms = self.__local.histograms = {}
+            with self.__lock:
+                self.__retire()
+                self.__shards.append((current_thread(), histograms))
+            return histograms
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        family = self.__shard().setdefault(name, {})
+        histogram = family.get(key, None)
+        if histogram is None:
+            histogram = family[key] = Histogram()
+        histogram.observe(value)
+
+    def __merged(self):
+        merged = {}
+        with self.__lock:
+            self.__retire()
+            self.__fold(merged, self.__retired)
+            shards = [shard for _, shard in self.__shards]
+        for shard in shards:
+            self.__fold(merged, shard)
+        return merged
+
+    def render(self):
+        lines = []
+        histograms = self.__merged()
+        for name in sorted(histograms):
+            if name in self.__help:
+                lines.append(u'# HELP {} {}'.format(name, self.__help[name]))
+            lines.append(u'# TYPE {} histogram'.format(name))
+            for key, histogram in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    labels = label_str(key + (('le', bound),))
+                    lines.append(u'{}_bucket{{{}}} {}'.format(name, labels, cumulative))
+                labels = u'{{{}}}'.format(label_str(key)) if key else u''
+                lines.append(u'{}_sum{} {}'.format(name, labels, histogram.sum))
+                lines.append(u'{}_count{} {}'.format(name, labels, histogram.count))
+        return u'\n'.join(lines) + u'\n'
+
+    def clear(self):
+        with self.__lock:
+            self.__retired.clear()
+            for _, shard in self.__shards:
+                shard.clear()
+
+
+metrics = MetricsRegistry()
+metrics.describe('agora_gql_phase_seconds', 'Time spent in each phase of query processing')
+metrics.describe('agora_gql_field_seconds', 'Time spent resolving each field')
+
+
+def render_counters(name, help, samples):
+    """
+    Renders (labels dict, value) samples of a counter or gauge family that is computed at scrape time.
+    """
+    lines = [u'# HELP {} {}'.format(name, help), u'# TYPE {} {}'.format(name, 'counter' if name.endswith(
+        '_total') else 'gauge')]
+    for labels, value in samples:
+        lines.append(u'{}{{{}}} {}'.format(name, label_str(sorted(labels.items())), value))
+    return u'\n'.join(lines) + u'\n'
+
+
+CACHE_COUNTERS = (('hits', 'agora_gql_cache_hits_total', 'Cache lookups that found an entry'),
+                  ('misses', 'agora_gql_cache_misses_total', 'Cache lookups that missed'),
+                  ('evictions', 'agora_gql_cache_evictions_total', 'Entries evicted to make room for new ones'),
+                  ('size', 'agora_gql_cache_entries', 'Entries currently held'),
+                  ('bytes', 'agora_gql_cache_bytes', 'Estimated size of the entries currently held'),
+                  ('max_bytes', 'agora_gql_cache_max_bytes', 'Size budget of the cache'))
+
+
+def cache_samples(stats, prefix=None):
+    """
+    Flattens nested cache stats into (cache name, stats) pairs, one per dict that counts hits.
+    """
+    for name, value in sorted(stats.items()):
+        if not isinstance(value, dict):
+            continue
+        name = u'{}.{}'.format(prefix, name) if prefix else name
+        if 'hits' in value:
+            yield name, value
+        for sample in cache_samples(value, name):
+            yield sample
+
+
+def render_caches(cache_stats):
+    samples = list(cache_samples(cache_stats))
+    return u''.join([render_counters(name, help, [({'cache': cache}, stats[key]) for cache, stats in samples
+                                                  if key in stats])
+                     for key, name, help in CACHE_COUNTERS])
+
+
+HOST_COUNTERS = (('failures', 'agora_gql_load_failures_total', 'Resource loads that failed'),
+                 ('short_circuits', 'agora_gql_load_short_circuits_total',
+                  'Resource loads skipped while the circuit of their host was open'),
+                 ('open', 'agora_gql_circuit_open', 'Whether the circuit of a host is open'))
+
+
+def render_hosts(hosts):
+    return u''.join([render_counters(name, help, [({'host': host}, int(health[key])) for host, health in
+                                                  sorted(hosts.items())])
+                     for key, name, help in HOST_COUNTERS])
+
+
+class Profile(object):
+    """
+    Timing breakdown of a single request: accumulated time and count per phase and per field.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__start = time()
+        self.phases = {}
+        self.fields = {}
+
+    @staticmethod
+    def __add(entries, name, seconds):
+        count, total = entries.get(name, (0, 0.0))
+        entries[name] = count + 1, total + seconds
+
+    def record(self, phase, seconds):
+        with self.__lock:
+            self.__add(self.phases, phase, seconds)
+
+    def record_field(self, field, seconds):
+        with self.__lock:
+            self.__add(self.fields, field, seconds)
+
+    def to_dict(self):
+        def entries(d):
+            return {name: {'count': count, 'ms': round(total * 1000, 3)} for name, (count, total) in d.items()}
+
+        with self.__lock:
+            return {
+                'ms': round((time() - self.__start) * 1000, 3),
+                'phases': entries(self.phases),
+                'fields': entries(self.fields)
+            }
+
+
+def observe_phase(phase, seconds, profile=None):
+    metrics.observe('agora_gql_phase_seconds', seconds, phase=phase)
+    if profile is not None:
+        profile.record(phase, seconds)
+
+
+def observe_field(field, seconds, profile=None):
+    metrics.observe('agora_gql_field_seconds', seconds, field=field)
+    if profile is not None:
+        profile.record_field(field, seconds)
+
+
+@contextmanager
+def timed(phase, profile=None):
+    start = time()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time() - start, profile)
+
+
+def timed_iter(items, phase, profile=None):
+    """
+    Passes items through, observing the time spent producing each of them.
+    """
+    it = iter(items)
+    try:
+        while True:
+            start = time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                observe_phase(phase, time() - start, profile)
+            yield item
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
@@ -17,86 +17,81 @@
 """
 import logging
 import traceback
-from threading import Lock
+from itertools import islice, imap
+from time import time
 
-from agora.engine.plan.agp import extend_uri
-from concurrent.futures import ThreadPoolExecutor
 from graphql import GraphQLNonNull, GraphQLList, GraphQLScalarType, GraphQLObjectType, GraphQLInterfaceType, \
     GraphQLUnionType
-from graphql.language.ast import InlineFragment
-from rdflib import URIRef, BNode, Graph, RDF
+from graphql.language.ast import Field, FragmentSpread
+from graphql.type.definition import get_named_type
 
+from agora_graphql.gql.abstract import AbstractTypeResolver, InlineConditions
+from agora_graphql.gql.cost import CardinalityStats, root_limit
 from agora_graphql.gql.data import data_graph
-from agora_graphql.misc import match
+from agora_graphql.gql.loader import BatchLoader, get_resource, resource_key, failures, set_loader
+from agora_graphql.gql.metrics import observe_field, timed_iter
+from agora_graphql.gql.pagination import paginate, field_pagination, encode_cursor
+from agora_graphql.gql.schema import field_predicates
+from agora_graphql.gql.subtree import Subtree, response_key
 
 __author__ = 'Fernando Serena'
 
-_lock = Lock()
-
 log = logging.getLogger('agora.gql.middleware')
 
-lock = Lock()
-
-tpool = ThreadPoolExecutor(max_workers=8)
-
-
-def load_resource(info, uri):
-    uri = URIRef(uri)
-    try:
-        log.debug(u'Pulling {}'.format(uri))
-        g, headers = info.context['load_fn'](uri)
-    except Exception:
-        g = Graph()
 
-    return g
+def composite_fields(info, parent_type, selection_set):
+    for s in selection_set.selections:
+        if isinstance(s, Field):
+            field_def = getattr(parent_type, 'fields', {}).get(s.name.value, None)
+            if field_def is not None and s.selection_set:
+                yield parent_type, s, get_named_type(field_def.type)
+        else:
+            fragment = info.fragments[s.name.value] if isinstance(s, FragmentSpread) else s
+            fragment_type = parent_type
+            if fragment.type_condition:
+                fragment_type = info.schema.get_type(fragment.type_condition.name.value)
+            for f in composite_fields(info, fragment_type, fragment.selection_set):
+                yield f
 
 
-def uri_lock(elm, info):
-    with _lock:
-        if elm not in info.context['locks']:
-            info.context['locks'][elm] = Lock()
-        return info.context['locks'][elm]
+def chunks(gen, size):
+    it = iter(gen)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            break
+        yield chunk
 
 
 def objects(cache, info, elm, predicate):
-    lock = uri_lock(elm, info)
-    elm_key = elm.toPython() if not isinstance(elm, basestring) else elm
-    pred_key = predicate.toPython()
-    with lock:
-        if elm_key not in cache:
-            future = tpool.submit(load_resource, info, elm)
-            g = future.result()
-            cache[elm_key] = {'_g': g}
-        if pred_key not in cache[elm_key]:
-            if elm.startswith('_'):
-                elm = BNode(elm)
-            else:
-                elm = URIRef(elm)
-
-            log.debug(u'Querying {} for {}'.format(elm, predicate))
-            res = map(lambda o: o.toPython(), cache[elm_key]['_g'].objects(elm, URIRef(predicate)))
-            cache[elm_key][pred_key] = res[:]
-
-        elif cache is not None:
-            res = cache[elm_key][pred_key][:]
-
-        return res
+    resource = get_resource(cache, info, elm)
+    log.debug(u'Querying {} for {}'.format(elm, predicate))
+    return resource.objects(predicate.toPython())
 
 
 class AgoraMiddleware(object):
-    def __init__(self, gateway, data_gw_cache=None, follow_cycles=True, **settings):
+    def __init__(self, gateway, data_gw_cache=None, type_cache=None, follow_cycles=True, fan_out=8, subtrees=None,
+                 **settings):
         self.gateway = gateway
+        self.subtrees = subtrees
         self.data_gw_cache = data_gw_cache
+        self.type_cache = type_cache if type_cache is not None else {}
         self.follow_cycles = follow_cycles
+        self.batch_loader = BatchLoader(data_gw_cache, fan_out=fan_out)
+        self.predicates = {}
+        self.type_resolvers = {}
+        self.inline_conditions = InlineConditions()
+        self.cardinality = CardinalityStats()
         self.settings = settings.copy()
 
-    def loader(self, dg):
+    def loader(self, dg, projection=None):
         def wrapper(uri):
             if uri:
                 if self.gateway.data_cache is not None:
+                    # Graphs in the data cache are shared with the crawler: they must be complete
                     g = self.gateway.data_cache.create(gid=uri, loader=dg.loader, format='text/turtle')
                 else:
-                    g = dg.loader(uri, format='text/turtle')
+                    g = dg.loader(uri, format='text/turtle', projection=projection)
 
                 return g
             else:
@@ -104,133 +99,251 @@ class AgoraMiddleware(object):
 
         return wrapper
 
-    def __check_matching_inline(self, info, types_n3):
-        inline_fragments = filter(lambda s: isinstance(s, InlineFragment),
-                                  reduce(lambda x, y: x + y.selection_set.selections, info.field_asts,
-                                         []))
-        inline_types = map(lambda i: i.type_condition.name.value, inline_fragments)
-        if not inline_types:
-            raise ValueError()
-        for it in inline_types:
-            if match(it, types_n3):
-                return info.schema.get_type(it)
-
-    def resolve_type(self, item, info):
-        lock = uri_lock(item, info)
-        with lock:
-            if item not in self.data_gw_cache:
-                future = tpool.submit(load_resource, info, item)
-                g = future.result()
-                self.data_gw_cache[item] = {'_g': g}
-            if 'type' not in self.data_gw_cache[item]:
-                g = self.data_gw_cache[item]['_g']
-                types = g.objects(URIRef(item), RDF.type)
-                types_n3 = set(map(lambda t: t.n3(g.namespace_manager), types))
-
-                res_type = None
-                if isinstance(info.return_type.of_type, GraphQLInterfaceType):
-                    interface_type = info.return_type.of_type.name
-                    corresponding_type = interface_type.lstrip('I')
-                    matching_types = set(match(corresponding_type, types_n3))
-                    if matching_types:
-                        try:
-                            res_type = self.__check_matching_inline(info, types_n3)
-                        except ValueError:
-                            res_type = info.schema.get_type(corresponding_type)
-
-                else:
-                    union_types_dict = {x.name: x for x in info.return_type.of_type.types}
-                    matching_types = filter(lambda (_, m): m,
-                                            {t: match(t, types_n3) for t in union_types_dict.keys()}.items())
+    def root_graph(self, operation, profile=None, **args):
+        data_graph_kwargs = args.copy()
+        data_graph_kwargs.update(self.settings)
+        return data_graph(operation, self.gateway, follow_cycles=self.follow_cycles, profile=profile,
+                          **data_graph_kwargs)
 
-                    if matching_types:
-                        try:
-                            res_type = self.__check_matching_inline(info, types_n3)
-                        except ValueError:
-                            pass
-
-                self.data_gw_cache[item]['type'] = res_type
+    def type_resolver(self, info, abstract_type):
+        resolvers = info.context.get('type_resolvers', self.type_resolvers)
+        try:
+            return resolvers[abstract_type.name]
+        except KeyError:
+            resolver = AbstractTypeResolver(abstract_type, info.schema)
+            resolvers[abstract_type.name] = resolver
+            return resolver
+
+    def type_key(self, item, info):
+        """
+        Resolved types depend on the inline fragments selected on the abstract field, not just on the item.
+        """
+        return resource_key(item), info.return_type.of_type.name, self.inline_conditions.get(info.field_asts)
 
-        return self.data_gw_cache[item]['type']
+    def resolve_type(self, item, info):
+        if isinstance(item, Subtree):
+            return info.schema.get_type(item.type_name)
 
-    def __filter_abstract_seed(self, seed, info):
-        type = self.resolve_type(seed, info)
-        return type is not None
+        key = self.type_key(item, info)
+        try:
+            type_name = self.type_cache[key]
+        except KeyError:
+            types_n3 = get_resource(self.data_gw_cache, info, item).types_n3
+            type_name = self.type_resolver(info, info.return_type.of_type).resolve(types_n3, key[2])
+            # Types of resources that failed to load are not known yet
+            if not failures.failed(key[0]):
+                self.type_cache[key] = type_name
+
+        return info.schema.get_type(type_name) if type_name else None
+
+    def field_predicates(self, info, parent_type_name, field_name):
+        table = info.context.get('predicates', self.predicates)
+        key = (parent_type_name, field_name)
+        try:
+            return table[key]
+        except KeyError:
+            predicates = field_predicates(info.context['fountain'], parent_type_name, field_name)
+            table[key] = predicates
+            return predicates
+
+    def invalidate_types(self, schema, type_names):
+        """
+        Forgets the resolved types of abstract fields that involve any of the given (changed) type names
+        or that no longer exist in the new schema.
+        """
+        type_names = set(type_names)
+        for key in list(self.type_cache.keys()):
+            abstract_type = schema.get_type(key[1])
+            stale = abstract_type is None or key[1] in type_names or any(
+                t.name in type_names for t in schema.get_possible_types(abstract_type))
+            if stale:
+                self.type_cache.pop(key, None)
+
+    def __prefetch_level(self, info, level):
+        """
+        Loads, level by level of the result tree, all resources that the given (uri, type, selection set)
+        entries and their composite sub-selections need.
+        """
+        while level:
+            self.batch_loader.load(info, [uri for uri, _, _ in level])
+            next_level = {}
+            for uri, parent_type, selection_set in level:
+                for field_type, field, child_type in composite_fields(info, parent_type, selection_set):
+                    # Children whose subtree is cached need no resources at all
+                    subtree_key = (child_type.name, self.subtrees.selection(info, [field])) if \
+                        self.subtrees is not None else None
+                    for predicate in self.field_predicates(info, field_type.name, field.name.value):
+                        children = objects(self.data_gw_cache, info, uri, predicate)
+                        if not isinstance(child_type, (GraphQLInterfaceType, GraphQLUnionType)):
+                            children = paginate(children, *field_pagination(info, field_type, field))
+                        for child in children:
+                            if isinstance(child, basestring) and (
+                                    subtree_key is None or (child,) + subtree_key not in self.subtrees):
+                                next_level[(child, child_type.name, id(field.selection_set))] = (
+                                    child, child_type, field.selection_set)
+                        break
+            level = next_level.values()
+
+    def __prefetch(self, info, seeds):
+        item_type = get_named_type(info.return_type)
+        selection_sets = [f.selection_set for f in info.field_asts if f.selection_set]
+
+        def level(uris):
+            return [(uri, item_type, selection_set) for uri in uris if isinstance(uri, basestring)
+                    for selection_set in selection_sets]
+
+        if isinstance(seeds, (list, tuple)):
+            self.__prefetch_level(info, level(seeds))
+            return seeds
+
+        def prefetching_gen():
+            for chunk in chunks(seeds, self.batch_loader.fan_out):
+                self.__prefetch_level(info, level(chunk))
+                for seed in chunk:
+                    yield seed
+
+        return prefetching_gen()
+
+    def __filter_abstract(self, info, seeds):
+        """
+        Seeds whose concrete type can be resolved, in their original order. Resources of the seeds whose type
+        is not known yet are loaded concurrently before classifying them, a batch of fan_out seeds at a time
+        if they come from an iterator (which is only consumed as far as the result is).
+        """
+        def classify(batch):
+            self.batch_loader.load(info, [seed for seed in batch if self.type_key(seed, info) not in self.type_cache])
+            return [seed for seed in batch if self.resolve_type(seed, info) is not None]
+
+        if isinstance(seeds, (list, tuple)):
+            return classify(seeds)
+
+        def filtering_gen():
+            try:
+                for chunk in chunks(seeds, self.batch_loader.fan_out):
+                    for seed in classify(chunk):
+                        yield seed
+            finally:
+                close = getattr(seeds, 'close', None)
+                if close is not None:
+                    close()
+
+        return filtering_gen()
+
+    def __cached_subtrees(self, seeds, key):
+        """
+        Seeds (URIs) replaced by their cached subtree for the given (type name, selection) key, if any.
+        """
+
+        def cached(seed):
+            subtree = self.subtrees.get(seed, *key) if isinstance(seed, basestring) else None
+            return subtree if subtree is not None else seed
+
+        if isinstance(seeds, (list, tuple)):
+            return [cached(seed) for seed in seeds]
+        return imap(cached, seeds)
 
     def resolve(self, next, root, info, **args):
         if info.context['introspection']:
             return next(root, info, **args)
 
-        fountain = info.context['fountain']
+        start = time()
+        try:
+            return self.__resolve(root, info, **args)
+        finally:
+            observe_field(u'{}.{}'.format(info.parent_type.name, info.field_name), time() - start,
+                          info.context.get('profile', None))
 
+    def __resolve(self, root, info, **args):
         try:
 
+            if isinstance(root, Subtree):
+                if self.subtrees is not None:
+                    self.subtrees.record_object(info, root.uri)
+                return root.values.get(response_key(info.field_asts[0]), None)
+
             non_nullable = isinstance(info.return_type, GraphQLNonNull)
             return_type = info.return_type.of_type if non_nullable else info.return_type
 
+            subtree_key = None
+            if self.subtrees is not None:
+                if isinstance(root, basestring):
+                    self.subtrees.record_object(info, root)
+                named_type = get_named_type(return_type)
+                if not isinstance(named_type, GraphQLScalarType):
+                    subtree_key = named_type.name, self.subtrees.selection(info)
+                    self.subtrees.record_selection(info, *subtree_key)
+
             if info.field_name == '_uri':
                 return root
 
+            if info.field_name == '_cursor':
+                return encode_cursor(root)
+
             if isinstance(return_type, GraphQLList):
+                pagination = args.pop('first', None), args.pop('after', None)
                 if not root:
-                    log.debug(u'Gathering seeds...')
-
-                    data_graph_kwargs = args.copy()
-                    data_graph_kwargs.update(self.settings)
-                    dg = data_graph(info.context['query'], self.gateway, data_gw_cache=self.data_gw_cache,
-                                    follow_cycles=self.follow_cycles,
-                                    **data_graph_kwargs)
-                    info.context['load_fn'] = self.loader(dg)
-                    info.context['locks'] = {}
-                    seeds = dg.roots
+                    seeds = info.context.get('seeds', None)
+                    if seeds is None:
+                        log.debug(u'Gathering seeds...')
+                        profile = info.context.get('profile', None)
+                        dg = self.root_graph(info.operation, profile=profile, **args)
+                        set_loader(info.context, info.path[0], self.loader(dg, info.context.get('projection', None)))
+                        # Operations of a batch share the crawls of the same roots
+                        crawls = info.context.get('crawls', None)
+                        roots = crawls.roots(dg) if crawls is not None else dg.roots
+                        seeds = timed_iter(roots, 'seeds', profile)
+                        seeds = self.cardinality.count(info.parent_type.name, info.field_name, seeds)
+                        pagination = root_limit(pagination[0], info.context), pagination[1]
+                    else:
+                        # Injected seeds are already paginated
+                        pagination = None, None
                 else:
                     seeds = []
-                    for parent_ty in match(info.parent_type.name, fountain.types):
-                        try:
-                            alias_prop = list(match(info.field_name, fountain.get_type(parent_ty)['properties'])).pop()
-                            prop_uri = extend_uri(alias_prop, fountain.prefixes)
-                            seeds = objects(self.data_gw_cache, info, root, prop_uri)
-                            break
-                        except IndexError:
-                            pass
-
-                if isinstance(info.return_type.of_type, GraphQLInterfaceType) or isinstance(info.return_type.of_type,
-                                                                                            GraphQLUnionType):
-                    seeds = filter(lambda x: self.__filter_abstract_seed(x, info), seeds)
+                    for prop_uri in self.field_predicates(info, info.parent_type.name, info.field_name):
+                        seeds = objects(self.data_gw_cache, info, root, prop_uri)
+                        self.cardinality.observe(info.parent_type.name, info.field_name, len(seeds))
+                        break
+
+                abstract = isinstance(info.return_type.of_type, GraphQLInterfaceType) or isinstance(
+                    info.return_type.of_type, GraphQLUnionType)
+                if abstract:
+                    # Only seeds of a concrete type count for pagination and are worth prefetching for
+                    seeds = self.__filter_abstract(info, seeds)
+                seeds = paginate(seeds, *pagination)
+                if subtree_key is not None:
+                    seeds = self.__cached_subtrees(seeds, subtree_key)
+
+                if seeds and not isinstance(get_named_type(return_type), GraphQLScalarType):
+                    seeds = self.__prefetch(info, seeds)
+
+                if abstract:
+                    seeds = list(seeds)
 
                 if seeds or non_nullable:
                     return seeds
 
             elif isinstance(return_type, GraphQLScalarType):
                 if root:
-                    for parent_ty in match(info.parent_type.name, fountain.types):
+                    for prop_uri in self.field_predicates(info, info.parent_type.name, info.field_name):
                         try:
-                            alias_prop = list(match(info.field_name, fountain.get_type(parent_ty)['properties'])).pop()
-                            prop_uri = URIRef(extend_uri(alias_prop, fountain.prefixes))
-                            try:
-                                value = objects(self.data_gw_cache, info, root, prop_uri).pop()
-                                return value
-                            except IndexError as e:
-                                if non_nullable:
-                                    raise Exception(e.message)
-                        except IndexError:
-                            pass
+                            value = objects(self.data_gw_cache, info, root, prop_uri)[-1]
+                            return value
+                        except IndexError as e:
+                            if non_nullable:
+                                raise Exception(e.message)
 
             elif isinstance(return_type, GraphQLObjectType):
                 if root:
-                    for parent_ty in match(info.parent_type.name, fountain.types):
+                    for prop_uri in self.field_predicates(info, info.parent_type.name, info.field_name):
                         try:
-                            alias_prop = list(match(info.field_name, fountain.get_type(parent_ty)['properties'])).pop()
-                            prop_uri = URIRef(extend_uri(alias_prop, fountain.prefixes))
-                            try:
-                                uri = objects(self.data_gw_cache, info, root, prop_uri).pop()
-                                if uri:
-                                    return uri
-                            except IndexError as e:
-                                if non_nullable:
-                                    raise Exception(e.message)
-                        except IndexError:
-                            pass
+                            uri = objects(self.data_gw_cache, info, root, prop_uri)[-1]
+                            if uri:
+                                if subtree_key is not None:
+                                    return self.subtrees.get(uri, *subtree_key) or uri
+                                return uri
+                        except IndexError as e:
+                            if non_nullable:
+                                raise Exception(e.message)
 
         except Exception as e:
             traceback.print_exc()
@@ -0,0 +1,101 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from itertools import islice
+
+from graphql.execution.values import get_argument_values
+
+from agora_graphql.gql.loader import resource_key
+
+__author__ = 'Fernando Serena'
+
+PAGINATION_ARGS = '(first: Int, after: String)'
+
+# Items of an iterator that are looked through for the one of an after cursor before giving up on it
+MAX_CURSOR_SCAN = 10000
+
+
+def encode_cursor(item):
+    key = resource_key(item)
+    return urlsafe_b64encode(key.encode('utf-8') if isinstance(key, unicode) else key)
+
+
+def decode_cursor(cursor):
+    try:
+        cursor = str(cursor)
+        key = urlsafe_b64decode(cursor)
+        if not key or urlsafe_b64encode(key) != cursor:
+            raise ValueError()
+        return key.decode('utf-8')
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError(u'Invalid cursor: {}'.format(cursor))
+
+
+def field_pagination(info, parent_type, field):
+    """
+    Values of the first and after arguments of a field AST (None if not given).
+    """
+    field_def = getattr(parent_type, 'fields', {}).get(field.name.value, None)
+    if field_def is None or not field.arguments:
+        return None, None
+    args = get_argument_values(field_def.args, field.arguments, info.variable_values)
+    return args.get('first', None), args.get('after', None)
+
+
+def paginate(items, first=None, after=None, max_scan=MAX_CURSOR_SCAN):
+    """
+    Restricts items to the first ones that come after the item of the given cursor. Iterators are
+    consumed lazily and closed as soon as the page is complete, so that their source (e.g. the crawl
+    generator) stops producing items. If the cursor's item is not among the first max_scan ones, the
+    page is empty.
+    Pages are as stable as the order of items: nested objects are sorted, but roots come in crawl
+    order, which agora does not guarantee to repeat, so root cursors are best-effort (pages of
+    different requests may overlap or skip roots).
+    """
+    if first is None and after is None:
+        return items
+
+    after_key = decode_cursor(after) if after is not None else None
+    if first is not None and first < 0:
+        raise ValueError(u'Invalid first value: {}'.format(first))
+
+    if isinstance(items, (list, tuple)):
+        start = 0
+        if after_key is not None:
+            keys = [resource_key(item) for item in items]
+            start = keys.index(after_key) + 1 if after_key in keys else len(items)
+        return items[start:start + first] if first is not None else items[start:]
+
+    def page():
+        it = iter(items)
+        try:
+            if after_key is not None:
+                for item in islice(it, max_scan):
+                    if resource_key(item) == after_key:
+                        break
+                else:
+                    # Not found: do not drain the rest of the source looking for it
+                    return
+            for item in (islice(it, first) if first is not None else it):
+                yield item
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    return page()
@@ -0,0 +1,188 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import logging
+import re
+from hashlib import sha1
+from urlparse import urljoin
+
+from rdflib import Graph, URIRef, RDF
+from rdflib.plugins.parsers.ntriples import NTriplesParser
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.projection')
+
+NT_MIMES = ('application/n-triples', 'text/plain')
+TURTLE_MIMES = ('text/turtle', 'application/x-turtle')
+
+# Turtle tokens that may contain statement terminators or nesting, and the terminators themselves
+TURTLE_TOKEN = re.compile(r'"""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^\'\\]|\\.|\'(?!\'\'))*\'\'\'|'
+                          r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'|<[^<>"{}|^`\\\s]*>|#[^\n]*|'
+                          r'\.(?=\s|#|$)|[\[\]()]', re.S)
+TURTLE_SKIP = re.compile(r'(?:\s|#[^\n]*)*')
+TURTLE_PREFIX = re.compile(r'(?:@prefix|PREFIX)\s+([^\s:]*):\s*<([^>]*)>\s*\.?', re.I)
+TURTLE_BASE = re.compile(r'(?:@base|BASE)\s+<([^>]*)>\s*\.?', re.I)
+TURTLE_IRI = re.compile(r'<([^>]*)>')
+TURTLE_PNAME = re.compile(r'([^\s:<\[("\']*):((?:[^\s;,\\]|\\.)*)')
+ABSOLUTE_IRI = re.compile(r'[a-zA-Z][\w+.-]*:')
+
+
+class Projection(object):
+    """
+    What resolvers may look up in the document of a resource: triples about the resource itself and,
+    optionally, only those with the given predicates (rdf:type is always kept). The digest identifies
+    the predicates, so that resources indexed from a projection are not used once it narrows them.
+    """
+    __slots__ = ('predicates', 'digest')
+
+    def __init__(self, predicates=None):
+        self.predicates = None
+        self.digest = None
+        if predicates is not None:
+            self.predicates = frozenset(predicates).union([RDF.type])
+            self.digest = sha1(' '.join(sorted(self.predicates)).encode('utf-8')).hexdigest()
+
+    def covers(self, digest):
+        return digest is None or digest == self.digest
+
+
+def table_projection(table):
+    """
+    Projection onto all predicates that a field resolution table may resolve fields with.
+    """
+    return Projection([p for predicates in table.values() for p in predicates])
+
+
+class ProjectedGraph(Graph):
+    """
+    Graph that only takes in the triples of a projection about one subject, so that the rest of a
+    document is dropped as soon as the parser produces it.
+    """
+
+    def __init__(self, subject, projection=None):
+        super(ProjectedGraph, self).__init__()
+        self.subject = URIRef(subject)
+        self.projection = projection
+        self.__predicates = projection.predicates if projection is not None else None
+
+    def add(self, triple):
+        s, p, o = triple
+        if s == self.subject and (self.__predicates is None or p in self.__predicates):
+            super(ProjectedGraph, self).add(triple)
+
+
+class ProjectedSink(object):
+    def __init__(self, graph):
+        self.graph = graph
+
+    def triple(self, s, p, o):
+        self.graph.add((s, p, o))
+
+
+def turtle_statements(text):
+    """
+    Splits a Turtle document into its top-level statements (directives included), without tokenizing
+    anything but literals, IRIs, comments and brackets.
+    """
+    start = 0
+    depth = 0
+    for m in TURTLE_TOKEN.finditer(text):
+        token = m.group()
+        if token in '[(':
+            depth += 1
+        elif token in '])':
+            depth -= 1
+        elif token == '.' and depth <= 0:
+            yield text[start:m.end()]
+            start = m.end()
+    if text[start:].strip():
+        yield text[start:]
+
+
+def resolve_iri(base, iri):
+    if ABSOLUTE_IRI.match(iri) or not base:
+        return iri
+    resolved = urljoin(base, iri)
+    # urljoin drops empty fragments, which namespaces often end with
+    return resolved + '#' if iri.endswith('#') and not resolved.endswith('#') else resolved
+
+
+def project_turtle(text, subject, base=None):
+    """
+    Turtle document with the directives and only the statements whose subject is the given one.
+    """
+    prefixes = {}
+    kept = []
+    for statement in turtle_statements(text):
+        i = TURTLE_SKIP.match(statement).end()
+        while True:
+            m = TURTLE_PREFIX.match(statement, i) or TURTLE_BASE.match(statement, i)
+            if m is None:
+                break
+            if m.re is TURTLE_PREFIX:
+                prefixes[m.group(1)] = resolve_iri(base, m.group(2))
+                kept.append(u'@prefix {}: <{}> .\n'.format(m.group(1), prefixes[m.group(1)]))
+            else:
+                base = resolve_iri(base, m.group(1))
+                kept.append(u'@base <{}> .\n'.format(base))
+            i = TURTLE_SKIP.match(statement, m.end()).end()
+
+        m = TURTLE_IRI.match(statement, i)
+        if m is not None:
+            s = resolve_iri(base, m.group(1))
+        else:
+            m = TURTLE_PNAME.match(statement, i)
+            s = prefixes[m.group(1)] + re.sub(r'\\(.)', r'\1', m.group(2)) if (
+                m is not None and m.group(1) in prefixes) else None
+        if s == subject:
+            kept.append(statement[i:] + '\n')
+    return ''.join(kept)
+
+
+def content_format(content_type, default=None):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in TURTLE_MIMES:
+        return 'turtle'
+    if content_type in NT_MIMES:
+        return 'nt'
+    return default
+
+
+def parse_projected(content, format, headers, subject, projection=None):
+    """
+    Parses a Turtle or N-Triples document keeping only what a projection needs about subject. N-Triples
+    lines of other subjects are not even parsed.
+    :return: A ProjectedGraph, or None if the document is in some other format
+    """
+    format = content_format(headers.get('Content-Type', None), default=content_format(format))
+    if format is None:
+        return None
+
+    g = ProjectedGraph(subject, projection)
+    if format == 'nt':
+        prefix = u'<{}>'.format(subject).encode('utf-8')
+        lines = [line for line in content if line.lstrip().startswith(prefix)]
+        NTriplesParser(ProjectedSink(g)).parsestring(''.join(lines))
+    else:
+        text = content.read()
+        g.parse(data=project_turtle(text.decode('utf-8'), unicode(subject), base=unicode(subject)),
+                format='turtle', publicID=subject)
+        if not len(g):
+            # Nothing about the subject in the statements kept: make sure by parsing the whole document
+            g.parse(data=text, format='turtle', publicID=subject)
+    return g
@@ -0,0 +1,73 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+from rdflib import URIRef, BNode, RDF
+
+__author__ = 'Fernando Serena'
+
+
+class Resource(object):
+    """
+    Read-only index of what a dereferenced document states about one resource:
+    predicate -> tuple of Python values, plus its rdf:types (as URIs and in n3 form).
+    'projection' is the digest of the predicates it was limited to when parsed, if any.
+    """
+    __slots__ = ('uri', 'predicates', 'types', 'types_n3', 'projection')
+
+    def __init__(self, uri, predicates=None, types=frozenset(), types_n3=frozenset(), projection=None):
+        self.uri = uri
+        self.predicates = predicates or {}
+        self.types = types
+        self.types_n3 = types_n3
+        self.projection = projection
+
+    def objects(self, predicate):
+        return self.predicates.get(predicate, ())
+
+    def __getstate__(self):
+        return self.uri, self.predicates, self.types, self.types_n3, self.projection
+
+    def __setstate__(self, state):
+        self.uri, self.predicates, self.types, self.types_n3 = state[:4]
+        self.projection = state[4] if len(state) > 4 else None
+
+
+def subject_node(uri):
+    return BNode(uri) if uri.startswith('_') else URIRef(uri)
+
+
+def term_order(term):
+    return term.n3()
+
+
+def ingest(g, uri, projection=None):
+    """
+    Indexes what g states about uri. The objects of each predicate are sorted: graphs yield them in no
+    particular order, which would change with every fetch (and process) and so would pages and cursors.
+    """
+    subject = subject_node(uri)
+    predicates = {}
+    for p, o in g.predicate_objects(subject):
+        predicates.setdefault(p.toPython(), []).append(o)
+
+    types = list(g.objects(subject, RDF.type))
+    return Resource(uri,
+                    predicates={p: tuple([o.toPython() for o in sorted(objects, key=term_order)])
+                                for p, objects in predicates.items()},
+                    types=frozenset([t.toPython() for t in types]),
+                    types_n3=frozenset([t.n3(g.namespace_manager) for t in types]),
+                    projection=projection)
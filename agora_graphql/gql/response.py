@@ -0,0 +1,74 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import json
+from hashlib import sha1
+from time import time
+
+from agora_graphql.gql.document import normalize_query
+from agora_graphql.misc.cache import LRUCache
+
+__author__ = 'Fernando Serena'
+
+
+def response_key(query, variables=None, operation_name=None, parameters=None):
+    """
+    Digest of everything a response depends on. Queries are keyed by their normalized text, which keeps
+    every string literal (block strings included) verbatim, so that different queries never share a key.
+    """
+    key = json.dumps([normalize_query(query), variables or {}, operation_name, parameters or {}], sort_keys=True)
+    return sha1(key.encode('utf-8') if isinstance(key, unicode) else key).hexdigest()
+
+
+class CachedResponse(object):
+    __slots__ = ('body', 'status', 'etag', 'created')
+
+    def __init__(self, body, status, etag, created):
+        self.body = body
+        self.status = status
+        self.etag = etag
+        self.created = created
+
+
+class ResponseCache(object):
+    """
+    Bounded cache of encoded GraphQL responses, keyed by the normalized query, its variables,
+    operation name and request parameters. Responses expire together with the resources they
+    were built from.
+    """
+
+    def __init__(self, max_len=1000, max_age_seconds=300):
+        self.max_age = max_age_seconds
+        self.__cache = LRUCache(max_len=max_len, max_age_seconds=max_age_seconds)
+
+    def get(self, key):
+        return self.__cache.get(key)
+
+    def put(self, key, body, status=200):
+        response = CachedResponse(body, status, sha1(body).hexdigest(), time())
+        self.__cache[key] = response
+        return response
+
+    def ttl(self, response):
+        return max(0, int(self.max_age - (time() - response.created)))
+
+    def clear(self):
+        self.__cache.clear()
+
+    @property
+    def stats(self):
+        return self.__cache.stats
@@ -15,17 +15,31 @@
   limitations under the License.
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
+import json
 import logging
+import os
 import re
+import tempfile
+from functools import partial
+from hashlib import sha1
 
 from agora import Wrapper
 from agora.engine.plan.agp import extend_uri
 from agora_wot.blocks.td import TD
+from concurrent.futures import ThreadPoolExecutor
+from graphql import GraphQLObjectType, GraphQLInterfaceType
+from rdflib import URIRef
+
+from agora_graphql.gql.pagination import PAGINATION_ARGS
+from agora_graphql.misc import match, fountain_fingerprint
 
 __author__ = 'Fernando Serena'
 
 log = logging.getLogger('agora.gql.schema')
 
+# Revision of the generated type definitions; snapshots of other revisions are regenerated
+SDL_REVISION = 2
+
 
 def name(prefixed_name):
     return prefixed_name.split(':')[1]
@@ -96,6 +110,12 @@ def get_abstract_types(fountain):
                             p, {'type': 'Interface', 'for': concrete_range, 'base': super_range[0]})
 
 
+def attr_line(fountain, p, all_type_names):
+    p_type = attr_type(fountain, p, all_type_names)
+    args = PAGINATION_ARGS if p_type.startswith('[') else ''
+    return '\t{}{}: {}'.format(name(p), args, p_type)
+
+
 def serialize_type(fountain, t, all_type_names, abstract_types):
     t_dict = fountain.get_type(t)
     t_props = t_dict['properties']
@@ -104,7 +124,8 @@ def serialize_type(fountain, t, all_type_names, abstract_types):
     implements = [abstract_types[p]['base'] for p in abstract_refs if
                   abstract_types[p]['type'] == 'Interface']
 
-    attr_lines = ['\t{}: {}'.format(name(p), attr_type(fountain, p, all_type_names)) for p in t_props]
+    attr_lines = [attr_line(fountain, p, all_type_names) for p in t_props]
+    attr_lines.append('\t_cursor: String')
     attr_lines_str = '\n'.join(attr_lines)
 
     res = ''
@@ -123,8 +144,8 @@ def serialize_type(fountain, t, all_type_names, abstract_types):
 
 
 def query_args(args):
-    args = ', '.join(['{}: String'.format(arg.lstrip('$')) for arg in args])
-    return '({})'.format(args) if args else ''
+    args = ['first: Int', 'after: String'] + ['{}: String'.format(arg.lstrip('$')) for arg in sorted(args)]
+    return '({})'.format(', '.join(args))
 
 
 def serialize_queries(type_args):
@@ -132,51 +153,194 @@ def serialize_queries(type_args):
     return 'type Query {\n%s\n}' % '\n'.join(query_lines)
 
 
-def create_gql_schema(gateway):
-    log.info('Building GraphQL schema from Agora...')
-    fountain = Wrapper(gateway.agora.fountain)
-
-    types = filter(lambda x: fountain.get_type(x)['properties'], sorted(fountain.types))
-    all_type_names = {}
-    for t in types:
-        t_title = title(t)
-        if t_title in all_type_names:
-            t_title = ''.join(map(lambda x: x.title(), t.split(':')))
-
-        all_type_names[t] = t_title
-        all_type_names[t_title] = t
-
-    t_params = {}
-    prefixes = gateway.agora.fountain.prefixes
-    for t in types:
-        t_uri = extend_uri(t, prefixes)
-        t_ted = gateway.discover("""SELECT * WHERE { [] a <%s>}""" % t_uri, strict=True, lazy=False)
-        if t_ted.ecosystem.roots:
-            params = set()
-            for root in t_ted.ecosystem.roots:
-                if isinstance(root, TD):
-                    root_vars = t_ted.ecosystem.root_vars(root)
-                    td_vars = filter(lambda x: x != '$item' and x != '$parent', root_vars)
-                    params.update(set(td_vars))
-
-            t_params[all_type_names[t]] = params
-
-    abstract_types = dict(get_abstract_types(fountain))
-    for abstract in abstract_types.values():
-        if abstract['type'] == 'Union':
-            union_type_names = map(lambda x: title(x), sorted(abstract['of']))
-            union_name = 'Union' + '_'.join(union_type_names)
-            all_type_names[union_name] = union_type_names
-
-    types_str = '\n'.join(
-        filter(lambda x: x, [serialize_type(fountain, t, all_type_names, abstract_types) for t in types]))
-    query_str = serialize_queries(t_params)
-    schema_str = "schema {\n\tquery: Query\n}"
-
-    unions_dict = {k: v for k, v in all_type_names.items() if k.startswith('Union')}
-    unions = ['union {}= {}'.format(u, '|'.join(union_types)) for u, union_types in unions_dict.items()]
-    unions_str = '\n'.join(unions)
-
-    res = '\n'.join([types_str, unions_str, query_str, schema_str])
+def discover_params(gateway, t_uri):
+    t_ted = gateway.discover("""SELECT * WHERE { [] a <%s>}""" % t_uri, strict=True, lazy=False)
+    if t_ted.ecosystem.roots:
+        params = set()
+        for root in t_ted.ecosystem.roots:
+            if isinstance(root, TD):
+                root_vars = t_ted.ecosystem.root_vars(root)
+                td_vars = filter(lambda x: x != '$item' and x != '$parent', root_vars)
+                params.update(set(td_vars))
+        return params
 
-    return res
+
+def type_digest(fountain, t, all_type_names, abstract_types):
+    """
+    Digest of everything serialize_type reads to generate the definition of type t.
+    """
+    t_dict = fountain.get_type(t)
+    t_props = {p: fountain.get_property(p) for p in t_dict['properties']}
+    ranges = set()
+    for p_dict in t_props.values():
+        if p_dict['type'] == 'object':
+            ranges.update(p_dict['range'])
+    range_types = {r: [fountain.get_type(r)['super'], fountain.get_type(r)['sub'], all_type_names.get(r)] for r in
+                   ranges}
+    abstract_refs = {p: abstract_types[p] for p in t_dict['refs'] if p in abstract_types}
+    digest = json.dumps([SDL_REVISION, t, all_type_names[t], t_dict, t_props, range_types, abstract_refs],
+                        sort_keys=True, default=sorted)
+    return sha1(digest).hexdigest()
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        pass
+
+
+def save_snapshot(path, fingerprint, schema, params, types):
+    snapshot = {
+        'revision': SDL_REVISION,
+        'fingerprint': fingerprint,
+        'schema': schema,
+        'params': {t: sorted(p) for t, p in params.items()},
+        'types': types
+    }
+    # Every worker may save the same snapshot: each one writes its own file, then swaps it in
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class SchemaBuilder(object):
+    """
+    Builds GraphQL schemas from a gateway. It remembers, per fountain type, the digest of its
+    inputs, its definition and its query parameters, so that rebuilds only regenerate and
+    rediscover the types that changed (see 'changed' and 'changed_names' after each build).
+    """
+
+    def __init__(self, gateway, snapshot_path=None, workers=8):
+        self.gateway = gateway
+        self.snapshot_path = snapshot_path
+        self.workers = workers
+        self.fingerprint = None
+        self.changed = set()
+        self.changed_names = set()
+        self.__types = {}
+
+    def __discover(self, types):
+        prefixes = self.gateway.agora.fountain.prefixes
+        pool = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        try:
+            type_uris = [extend_uri(t, prefixes) for t in types]
+            return dict(zip(types, pool.map(partial(discover_params, self.gateway), type_uris)))
+        finally:
+            pool.shutdown(wait=False)
+
+    def build(self, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = fountain_fingerprint(self.gateway.agora.fountain)
+
+        if self.snapshot_path and not self.__types:
+            snapshot = load_snapshot(self.snapshot_path)
+            if snapshot is not None:
+                self.__types = snapshot.get('types', {})
+                if snapshot.get('fingerprint') == fingerprint and snapshot.get('revision') == SDL_REVISION:
+                    log.info('Loading GraphQL schema snapshot from {}...'.format(self.snapshot_path))
+                    self.fingerprint = fingerprint
+                    return snapshot['schema']
+
+        log.info('Building GraphQL schema from Agora...')
+        fountain = Wrapper(self.gateway.agora.fountain)
+
+        types = filter(lambda x: fountain.get_type(x)['properties'], sorted(fountain.types))
+        all_type_names = {}
+        for t in types:
+            t_title = title(t)
+            if t_title in all_type_names:
+                t_title = ''.join(map(lambda x: x.title(), t.split(':')))
+
+            all_type_names[t] = t_title
+            all_type_names[t_title] = t
+
+        abstract_types = dict(get_abstract_types(fountain))
+        digests = {t: type_digest(fountain, t, all_type_names, abstract_types) for t in types}
+        changed = set(filter(lambda t: self.__types.get(t, {}).get('digest') != digests[t], types))
+        removed = set(self.__types).difference(types)
+        if changed:
+            log.info('Generating {} GraphQL type definitions...'.format(len(changed)))
+        discovered = self.__discover(sorted(changed))
+
+        type_entries = {}
+        for t in types:
+            if t in changed:
+                params = discovered[t]
+                type_entries[t] = {
+                    'name': all_type_names[t],
+                    'digest': digests[t],
+                    'sdl': serialize_type(fountain, t, all_type_names, abstract_types),
+                    'params': sorted(params) if params is not None else None
+                }
+            else:
+                type_entries[t] = self.__types[t]
+
+        t_params = {all_type_names[t]: set(entry['params']) for t, entry in type_entries.items() if
+                    entry['params'] is not None}
+
+        for abstract in abstract_types.values():
+            if abstract['type'] == 'Union':
+                union_type_names = map(lambda x: title(x), sorted(abstract['of']))
+                union_name = 'Union' + '_'.join(union_type_names)
+                all_type_names[union_name] = union_type_names
+
+        types_str = '\n'.join(filter(lambda x: x, [type_entries[t]['sdl'] for t in types]))
+        query_str = serialize_queries(t_params)
+        schema_str = "schema {\n\tquery: Query\n}"
+
+        unions_dict = {k: v for k, v in all_type_names.items() if k.startswith('Union')}
+        unions = ['union {}= {}'.format(u, '|'.join(union_types)) for u, union_types in unions_dict.items()]
+        unions_str = '\n'.join(unions)
+
+        res = '\n'.join([types_str, unions_str, query_str, schema_str])
+
+        self.changed = changed.union(removed)
+        self.changed_names = set([all_type_names[t] for t in changed] + [self.__types[t]['name'] for t in removed])
+        self.fingerprint = fingerprint
+        self.__types = type_entries
+
+        if self.snapshot_path:
+            log.info('Saving GraphQL schema snapshot to {}...'.format(self.snapshot_path))
+            save_snapshot(self.snapshot_path, fingerprint, res, t_params, type_entries)
+
+        return res
+
+
+def create_gql_schema(gateway, snapshot_path=None, fingerprint=None, workers=8):
+    return SchemaBuilder(gateway, snapshot_path=snapshot_path, workers=workers).build(fingerprint)
+
+
+def field_predicates(fountain, type_name, field_name):
+    predicates = []
+    for parent_ty in match(type_name, fountain.types):
+        try:
+            alias_prop = list(match(field_name, fountain.get_type(parent_ty)['properties'])).pop()
+            predicates.append(URIRef(extend_uri(alias_prop, fountain.prefixes)))
+        except IndexError:
+            pass
+    return tuple(predicates)
+
+
+def build_resolution_table(schema, fountain):
+    """
+    Maps every (GraphQL type, field name) of a schema to the candidate predicate URIs
+    that may resolve it, in the order the fountain yields them.
+    """
+    log.info('Building field resolution table...')
+    query_type = schema.get_query_type()
+    table = {}
+    for gql_type in schema.get_type_map().values():
+        if gql_type is query_type or gql_type.name.startswith('__'):
+            continue
+        if isinstance(gql_type, (GraphQLObjectType, GraphQLInterfaceType)):
+            for field_name in gql_type.fields:
+                table[(gql_type.name, field_name)] = field_predicates(fountain, gql_type.name, field_name)
+    return table
@@ -15,12 +15,14 @@
   limitations under the License.
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
+from itertools import count
+
 from agora.engine.plan import AGP
 from graphql import parse
-from graphql.language.ast import Field
-from shortuuid import uuid
+from graphql.language.ast import Field, Document, OperationDefinition
+from graphql.language.printer import print_ast
 
-from agora_graphql.misc import match
+from agora_graphql.misc import match, build_id
 
 __author__ = 'Fernando Serena'
 
@@ -35,14 +37,20 @@ def identify_property(parent_type, p, fountain):
 
 def identify_parent_type(selection, fountain):
     cand_parent_types = list(match(selection, fountain.types))
-    field_names = [f.name.value for f in selection.selection_set.selections if isinstance(f, Field)]
+    field_names = [f.name.value for f in selection.selection_set.selections if
+                   isinstance(f, Field) and not f.name.value.startswith('_')]
 
     for t in cand_parent_types:
         if all([identify_property(t, p, fountain) for p in field_names]):
             return t
 
 
-def process_selection(fountain, selection, parent_var=None, parent_type=None, parent_prop=None, root_mode=True):
+def new_var(variables):
+    return '?v{}'.format(next(variables))
+
+
+def process_selection(fountain, selection, variables, parent_var=None, parent_type=None, parent_prop=None,
+                      root_mode=True):
     var = None
     ty = None
     prop = None
@@ -52,7 +60,7 @@ def process_selection(fountain, selection, parent_var=None, parent_type=None, pa
             ty = identify_parent_type(selection, fountain)
             if ty:
                 if not parent_var:
-                    var = '?v' + str(uuid())
+                    var = new_var(variables)
                 else:
                     var = parent_var
                 tp = '{} {} {}'.format(var, 'a', ty)
@@ -62,8 +70,8 @@ def process_selection(fountain, selection, parent_var=None, parent_type=None, pa
                 prop = list(match(selection, fountain.properties)).pop()
                 if prop:
                     if not parent_var:
-                        parent_var = '?v' + str(uuid())
-                    var = '?v' + str(uuid())
+                        parent_var = new_var(variables)
+                    var = new_var(variables)
                     tp = '{} {} {}'.format(parent_var, prop, var)
                     yield tp
 
@@ -75,27 +83,57 @@ def process_selection(fountain, selection, parent_var=None, parent_type=None, pa
                 cand_props = reduce(lambda x, y: x.union(set(fountain.get_type(y)['properties'])), parent_range, set())
                 prop = list(match(selection, cand_props)).pop()
             if prop:
-                var = '?v' + str(uuid())
+                var = new_var(variables)
                 tp = '{} {} {}'.format(parent_var, prop, var)
                 yield tp
 
         if not root_mode and selection.selection_set:
             for s in selection.selection_set.selections:
-                for tp in process_selection(fountain, s, parent_var=var, parent_type=ty, parent_prop=prop):
+                for tp in process_selection(fountain, s, variables, parent_var=var, parent_type=ty, parent_prop=prop):
                     yield tp
     except IndexError:
         pass
 
 
+def query_operations(gql_query):
+    if isinstance(gql_query, basestring):
+        gql_query = parse(gql_query)
+    if isinstance(gql_query, OperationDefinition):
+        return [gql_query]
+    if isinstance(gql_query, Document):
+        return [d for d in gql_query.definitions if getattr(d, 'operation', None) == 'query']
+    return []
+
+
+def selection_key(selection, depth=None):
+    if not isinstance(selection, Field):
+        return print_ast(selection)
+
+    sub_key = ()
+    if selection.selection_set and depth != 0:
+        sub_depth = depth - 1 if depth is not None else None
+        sub_key = tuple(sorted([selection_key(s, sub_depth) for s in selection.selection_set.selections]))
+    return build_id(selection), sub_key
+
+
+def query_key(gql_query, root_mode=False):
+    """
+    Canonical key of the part of a GraphQL query that determines its translation to SPARQL.
+    In root mode, only root fields and the names of their direct sub-fields are relevant.
+    """
+    depth = 1 if root_mode else None
+    return root_mode, tuple([selection_key(s, depth) for d in query_operations(gql_query)
+                             for s in d.selection_set.selections])
+
+
 def sparql_from_graphql(fountain, gql_query, root_mode=False):
-    ast = parse(gql_query)
+    variables = count()
     tps = []
-    for d in ast.definitions:
-        if d.operation == 'query':
-            var = '?v' + str(uuid())
-            for s in d.selection_set.selections:
-                tps.extend(list(process_selection(fountain, s, parent_var=var, root_mode=root_mode)))
+    for d in query_operations(gql_query):
+        var = new_var(variables)
+        for s in d.selection_set.selections:
+            tps.extend(list(process_selection(fountain, s, variables, parent_var=var, root_mode=root_mode)))
 
     agp = AGP(set(tps), prefixes=fountain.prefixes)
-    query = 'SELECT DISTINCT * WHERE {}'.format(agp)
+    query = 'SELECT DISTINCT * WHERE {{ {} }}'.format(' . '.join(sorted([str(tp) for tp in agp])))
     return query
@@ -0,0 +1,184 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import json
+from hashlib import sha1
+
+from graphql.language.ast import FragmentSpread
+from graphql.language.printer import print_ast
+
+from agora_graphql.misc.cache import LRUCache
+
+__author__ = 'Fernando Serena'
+
+
+class Subtree(object):
+    """
+    Resolved selection of one resource: its concrete GraphQL type and the (serialized) values of the selected
+    fields by response key, where objects are Subtrees too.
+    """
+    __slots__ = ('uri', 'type_name', 'values')
+
+    def __init__(self, uri, type_name, values):
+        self.uri = uri
+        self.type_name = type_name
+        self.values = values
+
+
+def spread_names(selection_set, fragments, names):
+    for s in selection_set.selections:
+        if isinstance(s, FragmentSpread):
+            if s.name.value not in names:
+                names.add(s.name.value)
+                spread_names(fragments[s.name.value].selection_set, fragments, names)
+        elif s.selection_set:
+            spread_names(s.selection_set, fragments, names)
+    return names
+
+
+def selection_text(field_asts, fragments):
+    """
+    Normalized text of the selection sets of some field ASTs, including the fragments they spread.
+    """
+    names = set()
+    for f in field_asts:
+        spread_names(f.selection_set, fragments, names)
+    return u'\n'.join([print_ast(f.selection_set) for f in field_asts] +
+                      [print_ast(fragments[name]) for name in sorted(names)])
+
+
+def response_key(field_ast):
+    return field_ast.alias.value if field_ast.alias else field_ast.name.value
+
+
+def lookup(data, path):
+    for step in path:
+        try:
+            data = data[step]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return data
+
+
+class SubtreeCache(object):
+    """
+    Cross-request cache of resolved field subtrees, keyed by resource URI, the GraphQL type of the field that
+    leads to it and a digest of the field's selection set (and of the variables of the query).
+    While a query runs, the middleware records where each resource and selection lands in the result; once
+    it finished, the subtrees are taken from the result. Resolvers then answer from a cached subtree instead
+    of descending into the resource again. Subtrees of degraded or failed results are never stored, and
+    none of them outlive the resources they were built from (max_age_seconds).
+    """
+
+    def __init__(self, max_len=10000, max_age_seconds=300, max_bytes=None):
+        self.__cache = LRUCache(max_len=max_len, max_age_seconds=max_age_seconds, max_bytes=max_bytes)
+        self.__digests = {}
+        self.stored = 0
+
+    def selection(self, info, field_asts=None):
+        """
+        Digest of the selection of the field being resolved (or of the given field ASTs).
+        """
+        field_asts = info.field_asts if field_asts is None else field_asts
+        key = tuple(field_asts)
+        digest = self.__digests.get(key, None)
+        if digest is None:
+            digest = sha1(selection_text(field_asts, info.fragments).encode('utf-8')).hexdigest()
+            if len(self.__digests) >= self.__cache.max_len:
+                self.__digests.clear()
+            self.__digests[key] = digest
+        if info.variable_values:
+            digest = sha1(json.dumps([digest, info.variable_values], sort_keys=True)).hexdigest()
+        return digest
+
+    def get(self, uri, type_name, selection):
+        return self.__cache.get((uri, type_name, selection))
+
+    def __contains__(self, key):
+        return key in self.__cache
+
+    @staticmethod
+    def track(context):
+        """
+        Makes the middleware record where resources land in the result of the query executed with context.
+        Contexts shared by several operations (batches) must not be tracked.
+        """
+        context['subtrees'] = {}, {}
+
+    @staticmethod
+    def record_selection(info, type_name, selection):
+        """
+        Notes that the field being resolved leads to objects of type_name with the given selection.
+        """
+        record = info.context.get('subtrees', None)
+        if record is not None:
+            record[0][tuple(info.path)] = type_name, selection
+
+    @staticmethod
+    def record_object(info, uri):
+        """
+        Notes that the field being resolved belongs to the object of resource uri.
+        """
+        record = info.context.get('subtrees', None)
+        if record is not None:
+            record[1][tuple(info.path[:-1])] = uri, info.parent_type.name
+
+    def __subtree(self, data, path, objects):
+        uri, type_name = objects[path]
+        values = {}
+        for key, value in data.items():
+            if isinstance(value, dict):
+                value = self.__subtree(value, path + (key,), objects)
+            elif isinstance(value, list):
+                value = [self.__subtree(v, path + (key, i), objects) if isinstance(v, dict) else v
+                         for i, v in enumerate(value)]
+            values[key] = value
+        return Subtree(uri, type_name, values)
+
+    def store(self, context, data):
+        """
+        Caches the subtrees of the result data of a query, as recorded in its context.
+        """
+        selections, objects = context.pop('subtrees', ({}, {}))
+        if not data or context.get('degraded', False):
+            return
+
+        for path, (uri, _) in objects.items():
+            selection = selections.get(path[:-1] if isinstance(path[-1], int) else path, None)
+            if selection is None:
+                continue
+            key = (uri,) + selection
+            value = lookup(data, path)
+            if key in self.__cache or not isinstance(value, dict):
+                continue
+            try:
+                subtree = self.__subtree(value, path, objects)
+            except KeyError:
+                # Some object below was not resolved through the middleware: its type is unknown
+                continue
+            self.__cache[key] = subtree
+            self.stored += 1
+
+    def clear(self):
+        self.__cache.clear()
+        self.__digests.clear()
+
+    @property
+    def stats(self):
+        stats = self.__cache.stats
+        stats['stored'] = self.stored
+        return stats
@@ -0,0 +1,74 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+
+import atexit
+import logging
+import os
+from threading import Lock, Thread, Event
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.watcher')
+
+
+class SchemaWatcher(object):
+    """
+    Periodically asks a processor to reload its schema from a background thread. The thread is started
+    lazily and once per process, so that it also runs in workers forked after the processor was built.
+    With plans_only, the schema is left as is and only the cached plans are checked against the fountain.
+    """
+
+    def __init__(self, processor, interval=60, plans_only=False):
+        self.processor = processor
+        self.interval = interval
+        self.plans_only = plans_only
+        self.__lock = Lock()
+        self.__pid = None
+        self.__thread = None
+        self.__stop = Event()
+
+    def __running(self):
+        return self.__pid == os.getpid() and self.__thread is not None and self.__thread.is_alive()
+
+    def ensure_running(self):
+        if self.__running():
+            return
+
+        with self.__lock:
+            if not self.__running():
+                self.__stop = Event()
+                self.__thread = Thread(target=self.__run, args=(self.__stop,), name='agora-gql-schema-watcher')
+                self.__thread.daemon = True
+                self.__thread.start()
+                self.__pid = os.getpid()
+                # Do not let the thread outlive the interpreter's modules
+                atexit.register(self.__stop.set)
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                if self.plans_only:
+                    if self.processor.check_fountain():
+                        log.info('Fountain changed: cached plans dropped')
+                elif self.processor.reload():
+                    log.info('GraphQL schema reloaded')
+            except Exception as e:
+                log.warning('Schema reload failed: {}'.format(e))
@@ -15,6 +15,9 @@
   limitations under the License.
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
+import json
+from hashlib import sha1
+
 from graphql.language.ast import Field
 
 __author__ = 'Fernando Serena'
@@ -36,3 +39,14 @@ def match(s, elms):
     s = build_id(s).lower()
     m = filter(lambda e: e.lower().endswith(s), elms)
     return list(m)
+
+
+def fountain_fingerprint(fountain):
+    """
+    Digest of everything in a fountain that GraphQL schemas and SPARQL translations depend on.
+    """
+    types = {t: fountain.get_type(t) for t in fountain.types}
+    properties = {p: fountain.get_property(p) for p in fountain.properties}
+    prefixes = {p: unicode(uri) for p, uri in dict(fountain.prefixes).items()}
+    digest = json.dumps([types, properties, prefixes], sort_keys=True, default=sorted)
+    return sha1(digest).hexdigest()
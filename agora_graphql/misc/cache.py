@@ -0,0 +1,176 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import sys
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+__author__ = 'Fernando Serena'
+
+
+def approximate_size(obj, seen=None):
+    """
+    Bytes taken by an object and everything it holds, as far as built-in containers, strings and
+    slotted objects go. Objects shared between entries are counted for each of them.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum([approximate_size(k, seen) + approximate_size(v, seen) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum([approximate_size(v, seen) for v in obj])
+    elif hasattr(obj, '__slots__'):
+        size += sum([approximate_size(getattr(obj, a, None), seen) for a in obj.__slots__])
+    return size
+
+
+class Entry(object):
+    __slots__ = ('value', 'ts', 'size', 'used')
+
+    def __init__(self, value, ts, size):
+        self.value = value
+        self.ts = ts
+        self.size = size
+        self.used = False
+
+
+class LRUCache(object):
+    """
+    Thread-safe, bounded dictionary that evicts its (approximately) least recently used entries.
+    Entries optionally expire after max_age_seconds. Besides a number of entries, it may be bounded
+    by max_bytes: the estimated size of all keys plus that of the values, as measured by sizeof
+    (approximate_size by default).
+    Lookups take no lock: a hit only flags its entry as used. Entries are kept in insertion order and,
+    when making room, flagged ones get a second chance at the end of the line instead of being evicted.
+    Hit and miss counts are not synchronized either, so they are approximate under concurrency.
+    """
+
+    def __init__(self, max_len=1000, max_age_seconds=None, max_bytes=None, sizeof=None):
+        self.max_len = max_len
+        self.max_age = max_age_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or approximate_size
+        self.__data = OrderedDict()
+        self.__lock = Lock()
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __expired(self, ts):
+        return self.max_age is not None and time() - ts > self.max_age
+
+    def __discard(self, key):
+        entry = self.__data.pop(key)
+        self.__bytes -= entry.size
+        return entry.value
+
+    def __full(self):
+        return len(self.__data) > self.max_len or (self.max_bytes is not None and self.__bytes > self.max_bytes)
+
+    def __evict(self):
+        key = next(iter(self.__data))
+        entry = self.__data[key]
+        if entry.used and not self.__expired(entry.ts):
+            entry.used = False
+            del self.__data[key]
+            self.__data[key] = entry
+        else:
+            self.__discard(key)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        entry = self.__data.get(key, None)
+        if entry is None or self.__expired(entry.ts):
+            self.misses += 1
+            return default
+        entry.used = True
+        self.hits += 1
+        return entry.value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        size = approximate_size(key) + self.sizeof(value) if self.max_bytes is not None else 0
+        with self.__lock:
+            if key in self.__data:
+                self.__discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Larger than the whole budget: making room for it would flush everything else
+                self.evictions += 1
+                return
+            self.__data[key] = Entry(value, time(), size)
+            self.__bytes += size
+            while self.__full():
+                self.__evict()
+
+    def __delitem__(self, key):
+        with self.__lock:
+            self.__discard(key)
+
+    def __contains__(self, key):
+        entry = self.__data.get(key, None)
+        return entry is not None and not self.__expired(entry.ts)
+
+    def __len__(self):
+        return len(self.__data)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            try:
+                return self.__discard(key)
+            except KeyError:
+                return default
+
+    def keys(self):
+        with self.__lock:
+            return list(self.__data.keys())
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.__bytes = 0
+
+    @property
+    def bytes(self):
+        return self.__bytes
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {
+            'size': len(self.__data),
+            'max_len': self.max_len,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0
+        }
+        if self.max_bytes is not None:
+            stats['bytes'] = self.__bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
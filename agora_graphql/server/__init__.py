@@ -17,10 +17,11 @@
 """
 
 from agora_gw import Gateway
-from flask import Flask
+from flask import Flask, Response
 from flask_cors import CORS
 
 from agora_graphql.gql import GraphQLProcessor
+from agora_graphql.gql.metrics import metrics, render_caches, render_hosts
 from agora_graphql.server.view import AgoraGraphQLView
 
 __author__ = 'Fernando Serena'
@@ -30,15 +31,38 @@ def build(**kwargs):
     app = Flask(__name__)
     CORS(app)
 
-    schema_path = kwargs.get('schema', {}).get('path', None)
+    schema_config = kwargs.get('schema', {})
+    schema_path = schema_config.get('path', None)
 
     gw = Gateway(**kwargs['gateway'])
-    gql_processor = GraphQLProcessor(gw, schema_path, data_gw_cache=kwargs.get('gw_cache', None))
+    gql_processor = GraphQLProcessor(gw, schema_path, data_gw_cache=kwargs.get('gw_cache', None),
+                                     snapshot_path=schema_config.get('snapshot', None),
+                                     schema_workers=schema_config.get('workers', 8),
+                                     watch_interval=schema_config.get('watch', None),
+                                     plan_check_interval=schema_config.get('plan_check', 60),
+                                     document_cache=kwargs.get('document_cache', None),
+                                     persisted_queries=kwargs.get('persisted_queries', None),
+                                     response_cache=kwargs.get('response_cache', None),
+                                     cost=kwargs.get('cost', None),
+                                     fetch=kwargs.get('fetch', None),
+                                     load_failures=kwargs.get('load_failures', None),
+                                     project_predicates=kwargs.get('project_predicates', False),
+                                     type_cache=kwargs.get('type_cache', None),
+                                     plan_cache=kwargs.get('plan_cache', None),
+                                     subtree_cache=kwargs.get('subtree_cache', None),
+                                     executor=kwargs.get('executor', 'sync'),
+                                     executor_workers=kwargs.get('executor_workers', 16),
+                                     fan_out=kwargs.get('fan_out', 8))
 
     app.add_url_rule('/graphql',
-                     view_func=AgoraGraphQLView.as_view('graphql', schema=gql_processor.schema,
-                                                        executor=gql_processor.executor,
-                                                        middleware=gql_processor.middleware,
-                                                        graphiql=True))
+                     view_func=AgoraGraphQLView.as_view('graphql', processor=gql_processor, graphiql=True,
+                                                        batch_workers=kwargs.get('batch_workers', 8)))
+
+    @app.route('/metrics')
+    def get_metrics():
+        # Metrics are kept per process: each worker reports its own
+        stats = gql_processor.cache_stats
+        body = metrics.render() + render_caches(stats) + render_hosts(stats['failures']['hosts'])
+        return Response(body, content_type='text/plain; version=0.0.4; charset=utf-8')
 
     return app
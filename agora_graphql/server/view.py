@@ -16,29 +16,330 @@
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
 """
 
+import json
+
+from concurrent.futures import ThreadPoolExecutor
 from flask_graphql import GraphQLView
+from graphql_server import HttpQueryError, SkipException, load_json_variables, get_graphql_params, get_response, \
+    format_execution_result
 
 __author__ = 'Fernando Serena'
 
-from flask import request
+from flask import request, Response
+
+from agora_graphql.gql.data import CrawlScope
+from agora_graphql.gql.executor import setup_context
+from agora_graphql.gql.metrics import Profile
+from agora_graphql.gql.response import response_key
+from agora_graphql.gql.subtree import SubtreeCache
+
+GRAPHQL_ARGS = ('query', 'variables', 'operationName', 'extensions')
+PROFILE_HEADER = 'X-Agora-Profile'
+
+
+def persisted_query_hash(data):
+    extensions = data.get('extensions', None)
+    if isinstance(extensions, basestring):
+        try:
+            extensions = json.loads(extensions)
+        except ValueError:
+            raise HttpQueryError(400, 'Extensions are invalid JSON.')
+
+    try:
+        return extensions['persistedQuery']['sha256Hash']
+    except (TypeError, KeyError):
+        return None
+
+
+def request_parameters():
+    return {arg: value for arg, value in request.args.items() if arg not in GRAPHQL_ARGS}
 
 
 class AgoraGraphQLView(GraphQLView):
+    processor = None
+    state = None
+    persisted = None
+    gql_data = None
+    body = None
+    responses = None
+    errors = False
+    context = None
+    profile = None
+    cache_max_age = 0
+    batch = True
+    batch_workers = 8
+
     def __init__(self, **kwargs):
+        processor = kwargs.get('processor', None)
+        if processor is not None:
+            processor.watch()
+            # Views are instantiated per request: pin the schema that is current now
+            self.state = processor.state
+            kwargs.setdefault('schema', self.state.schema)
+            kwargs.setdefault('executor', processor.executor)
+            kwargs.setdefault('middleware', processor.middleware)
+            kwargs.setdefault('backend', self.state.backend)
+            kwargs.setdefault('cache_max_age', processor.max_age)
+            kwargs.setdefault('responses', processor.responses)
+        if request.headers.get(PROFILE_HEADER, None):
+            self.profile = Profile()
         super(AgoraGraphQLView, self).__init__(**kwargs)
 
-    def get_context(self):
+    def get_backend(self):
+        backend = super(AgoraGraphQLView, self).get_backend()
+        if self.profile is not None and hasattr(backend, 'profiled'):
+            backend = backend.profiled(self.profile)
+        return backend
+
+    def __resolve_persisted(self, data):
+        """
+        Automatic persisted queries: requests may carry just the SHA-256 hash of a query that
+        was registered before; the full text is only sent (and registered) after a miss.
+        """
+        sha256_hash = persisted_query_hash(data)
+        if sha256_hash is None or self.state is None:
+            return data, None
+
+        q = data.get('query', None)
+        if q:
+            try:
+                persisted = self.state.persisted.register(sha256_hash, q)
+            except ValueError as e:
+                raise HttpQueryError(400, e.message)
+        else:
+            persisted = self.state.persisted.get(sha256_hash)
+            if persisted is None:
+                raise HttpQueryError(200, 'PersistedQueryNotFound')
+
+        data = dict(data.items())
+        data['query'] = persisted.query
+        return data, persisted
+
+    def parse_body(self):
+        if self.body is not None:
+            return self.body
+
+        data = super(AgoraGraphQLView, self).parse_body()
         if request.method == 'GET':
-            gql_query = request.args.get('query') or ''
+            data = dict(request.args.items())
+
+        # Persisted queries of a batch are resolved per operation, so that a miss only fails its own
+        if not isinstance(data, list):
+            data, self.persisted = self.__resolve_persisted(data)
+            self.gql_data = data
+
+        self.body = data
+        return data
+
+    def __complete(self, data, context):
+        """
+        Adds what the execution left in its context to a formatted result.
+        """
+        if data.get('errors'):
+            self.errors = True
+        extensions = context.get('extensions', None) if context is not None else None
+        if self.processor is not None and self.processor.subtrees is not None and context is not None \
+                and not data.get('errors'):
+            self.processor.subtrees.store(context, data.get('data', None))
+        if extensions and 'extensions' not in data:
+            data['extensions'] = extensions
+        return data
+
+    def encode(self, data, pretty=False):
+        if isinstance(data, dict):
+            data = self.__complete(data, self.context)
+        return super(AgoraGraphQLView, self).encode(data, pretty=pretty)
+
+    def __response_key(self):
+        """
+        Key of the cached response for the current request, or None if it must not be cached.
+        """
+        if request.method not in ('GET', 'POST') or (request.method == 'GET' and self.should_display_graphiql()):
+            return None
+
+        try:
+            data = self.parse_body()
+            if not isinstance(data, dict):
+                return None
+            query = data.get('query') or request.args.get('query')
+            if not query:
+                return None
+            variables = load_json_variables(data.get('variables') or request.args.get('variables'))
+            operation_name = data.get('operationName') or request.args.get('operationName')
+        except HttpQueryError:
+            return None
+
+        return response_key(query, variables, operation_name, request_parameters())
+
+    def __cache_control(self, response, max_age):
+        if request.method == 'GET':
+            response.headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
         else:
-            gql_query = request.json['query']
+            response.headers['Cache-Control'] = 'private, max-age={}'.format(max_age)
+
+    def request_wants_stream(self):
+        best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+        return best == 'application/x-ndjson' and \
+            request.accept_mimetypes[best] > request.accept_mimetypes['application/json']
+
+    def __stream(self):
+        """
+        Delivers the result as newline-delimited JSON payloads, one per root item as soon as it is resolved.
+        """
+        try:
+            data = self.parse_body()
+            if not isinstance(data, dict):
+                raise HttpQueryError(400, 'Batch GraphQL requests cannot be streamed.')
+            query = data.get('query') or request.args.get('query')
+            if not query:
+                raise HttpQueryError(400, 'Must provide query string.')
+            variables = load_json_variables(data.get('variables') or request.args.get('variables'))
+            operation_name = data.get('operationName') or request.args.get('operationName')
+        except HttpQueryError as e:
+            return Response(
+                self.encode({
+                    'errors': [self.format_error(e)]
+                }),
+                status=e.status_code,
+                headers=e.headers,
+                content_type='application/json'
+            )
+
+        payloads = self.processor.stream(query, variables=variables, operation_name=operation_name,
+                                         profile=self.profile)
+        return Response((self.encode(payload) + '\n' for payload in payloads), mimetype='application/x-ndjson')
+
+    def __batch(self, data):
+        """
+        Executes the operations of a batched request concurrently, each one with a context of its own.
+        All of them share a crawl scope: root fields that translate to the same plan (in any operation)
+        consume a single crawl. Resources are shared anyway, loads of the same one are never concurrent.
+        Errors of an operation (e.g. an unknown persisted query) are reported in its own result.
+        """
+        try:
+            if not data:
+                raise HttpQueryError(400, 'Received an empty list in the batch request.')
+            if not all([isinstance(entry, dict) for entry in data]):
+                raise HttpQueryError(400, 'GraphQL params should be a dict. Received {}.'.format(data))
+
+            base_context = self.get_context()
+            crawls = CrawlScope()
+            execute_options = {
+                'backend': self.get_backend(),
+                'root': self.get_root_value(),
+                'middleware': self.get_middleware()
+            }
+            executor = self.get_executor()
+            if executor:
+                execute_options['executor'] = executor
+            allow_only_query = request.method == 'GET'
+
+            def run(entry):
+                try:
+                    params = get_graphql_params(self.__resolve_persisted(entry)[0], {})
+                    context = self.operation_context(base_context, params.query or '')
+                    context['crawls'] = crawls
+                    result = get_response(self.schema, params, SkipException, allow_only_query, context=context,
+                                          **execute_options)
+                except HttpQueryError as e:
+                    return {'errors': [self.format_error(e)]}, e.status_code, None
+                data, status = format_execution_result(result, self.format_error)
+                return data, status, context
+
+            pool = ThreadPoolExecutor(max_workers=max(1, min(len(data), self.batch_workers)))
+            try:
+                outcomes = list(pool.map(run, data))
+            finally:
+                pool.shutdown()
+                crawls.close()
+        except HttpQueryError as e:
+            return Response(
+                self.encode({
+                    'errors': [self.format_error(e)]
+                }),
+                status=e.status_code,
+                headers=e.headers,
+                content_type='application/json'
+            )
+
+        results = []
+        status_code = 200
+        for data, status, context in outcomes:
+            results.append(self.__complete(data, context) if data is not None else None)
+            status_code = max(status_code, status)
 
-        q_params = dict(request.args.items())
-        if 'query' in q_params:
-            del q_params['query']
+        pretty = self.pretty or request.args.get('pretty')
+        return Response(self.encode(results, pretty=pretty), status=status_code, content_type='application/json')
+
+    def dispatch_request(self):
+        if self.processor is not None and request.method in ('GET', 'POST') and self.request_wants_stream():
+            return self.__stream()
+
+        if request.method == 'POST' and self.batch:
+            try:
+                data = self.parse_body()
+            except HttpQueryError:
+                # Reported as usual below
+                data = None
+            if isinstance(data, list):
+                return self.__batch(data)
+
+        # Profiled requests must actually run, so they neither use nor fill the response cache
+        key = self.__response_key() if self.responses is not None and self.profile is None else None
+        if key is None:
+            response = super(AgoraGraphQLView, self).dispatch_request()
+            if self.persisted is not None and request.method == 'GET' and response.status_code == 200 \
+                    and self.cache_max_age:
+                self.__cache_control(response, self.cache_max_age)
+            return response
+
+        cached = self.responses.get(key)
+        if cached is None:
+            response = super(AgoraGraphQLView, self).dispatch_request()
+            # Neither errors nor results of failed loads are cached beyond their own (negative) TTL
+            degraded = self.context is not None and self.context.get('degraded', False)
+            if response.status_code != 200 or self.errors or degraded:
+                return response
+            cached = self.responses.put(key, response.get_data(), response.status_code)
+
+        response = Response(cached.body, status=cached.status, content_type='application/json')
+        self.__cache_control(response, self.responses.ttl(cached))
+        response.set_etag(cached.etag)
+        return response.make_conditional(request)
+
+    def operation_context(self, context, gql_query):
+        """
+        Context of one of the operations of a batch, on top of the one of the request.
+        """
+        context = {k: v for k, v in context.items() if k not in ('subtrees', 'extensions')}
+        context['query'] = gql_query
+        context['introspection'] = 'introspection' in gql_query.lower()
+        if self.processor is not None and self.processor.subtrees is not None:
+            SubtreeCache.track(context)
+        return context
+
+    def get_context(self):
+        gql_query = (self.gql_data or {}).get('query', None) or ''
+        q_params = request_parameters()
+
+        if self.persisted is not None:
+            introspection = self.persisted.document.introspection
+        else:
+            introspection = 'introspection' in gql_query.lower()
 
-        return {
+        context = {
             'query': gql_query,
-            'introspection': 'introspection' in gql_query.lower(),
-            'parameters': q_params
+            'introspection': introspection,
+            'parameters': q_params,
+            'profile': self.profile
         }
+        if self.state is not None:
+            context['predicates'] = self.state.predicates
+            context['projection'] = self.state.projection
+            context['type_resolvers'] = self.state.type_resolvers
+        if self.processor is not None:
+            setup_context(self.processor.gateway, context)
+            if self.processor.subtrees is not None:
+                SubtreeCache.track(context)
+        self.context = context
+        return context
@@ -0,0 +1,301 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from graphql import parse, execute, MiddlewareManager, GraphQLList, GraphQLInterfaceType, GraphQLUnionType
+from graphql.type.definition import get_nullable_type
+
+from agora_graphql.gql import GraphQLProcessor
+from agora_graphql.gql.data import plans
+from agora_graphql.gql.schema import create_gql_schema
+from agora_graphql.gql.sparql import sparql_from_graphql
+from agora_graphql.misc import match
+from benchmarks.synthetic import SyntheticFountain, SyntheticGateway, local
+
+__author__ = 'Fernando Serena'
+
+log = logging.getLogger('agora.gql.benchmarks')
+
+
+def measure(fn, rounds=5, min_time=0.05):
+    """
+    Times fn in a number of rounds, each one calling it as many times as needed to take at least min_time.
+    :return: Per-call times (seconds) of the rounds
+    """
+    number = 1
+    while True:
+        start = default_timer()
+        for _ in xrange(number):
+            fn()
+        elapsed = default_timer() - start
+        if elapsed >= min_time:
+            break
+        number = number * 10 if elapsed < min_time / 10 else number * 2
+
+    times = [elapsed / number]
+    for _ in xrange(rounds - 1):
+        start = default_timer()
+        for _ in xrange(number):
+            fn()
+        times.append((default_timer() - start) / number)
+    return number, times
+
+
+def summary(number, times):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    return {
+        'number': number,
+        'rounds': len(times),
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': mean,
+        'stdev': (sum([(t - mean) ** 2 for t in times]) / len(times)) ** 0.5
+    }
+
+
+class ResolveRecorder(object):
+    """
+    Middleware that passes resolution on to the Agora middleware and records every call (and its result),
+    so that they can be replayed outside of graphql execution.
+    """
+
+    def __init__(self, middleware):
+        self.middleware = middleware
+        self.calls = []
+
+    def resolve(self, next, root, info, **args):
+        result = self.middleware.resolve(next, root, info, **args)
+        if root is not None:
+            self.calls.append((root, info, args, result))
+        return result
+
+
+class Suite(object):
+    def __init__(self, config):
+        self.config = config
+        self.fountain = SyntheticFountain(types=config['types'], attributes=config['attributes'],
+                                          unions=config['unions'], interfaces=config['interfaces'])
+        self.gateway = SyntheticGateway(self.fountain, size=config['size'], fan_out=config['fan_out'])
+        self.query = self.fountain.query(depth=config['depth'])
+        self.document = parse(self.query)
+
+        self.processor = GraphQLProcessor(self.gateway, response_cache={}, plan_check_interval=0)
+        fd, self.schema_path = tempfile.mkstemp(suffix='.graphql')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.processor.schema_text)
+
+        self.__calls = None
+
+    def close(self):
+        os.remove(self.schema_path)
+
+    @property
+    def calls(self):
+        """
+        Middleware calls of a warm execution of the benchmark query.
+        """
+        if self.__calls is None:
+            self.processor.query(self.query)
+            recorder = ResolveRecorder(self.processor.middleware.middlewares[0])
+            state = self.processor.state
+            result = execute(state.schema, self.document, context_value={
+                'query': self.query,
+                'introspection': False,
+                'predicates': state.predicates
+            }, middleware=MiddlewareManager(recorder))
+            if result.errors:
+                raise result.errors[0]
+            self.__calls = recorder.calls
+        return self.__calls
+
+    def bench_schema(self):
+        return lambda: create_gql_schema(self.gateway, workers=1)
+
+    def bench_sparql_root(self):
+        return lambda: sparql_from_graphql(self.fountain, self.document, root_mode=True)
+
+    def bench_sparql_full(self):
+        return lambda: sparql_from_graphql(self.fountain, self.document, root_mode=False)
+
+    def bench_match_types(self):
+        names = [local(t) for t in self.fountain.types]
+        return lambda: [match(n, self.fountain.types) for n in names]
+
+    def bench_match_properties(self):
+        names = [local(p) for p in self.fountain.properties]
+        return lambda: [match(n, self.fountain.properties) for n in names]
+
+    def bench_resolve(self):
+        middleware = self.processor.middleware.middlewares[0]
+        calls = [(root, info, args) for root, info, args, _ in self.calls]
+
+        def resolve_all():
+            for root, info, args in calls:
+                middleware.resolve(None, root, info, **args)
+
+        return resolve_all
+
+    def __abstract_items(self):
+        items = []
+        for _, info, _, result in self.calls:
+            return_type = get_nullable_type(info.return_type)
+            if isinstance(return_type, GraphQLList) and isinstance(return_type.of_type, (GraphQLInterfaceType,
+                                                                                         GraphQLUnionType)):
+                items.extend([(item, info) for item in result or []])
+        return items
+
+    def bench_resolve_type_warm(self):
+        middleware = self.processor.middleware.middlewares[0]
+        items = self.__abstract_items()
+        return lambda: [middleware.resolve_type(item, info) for item, info in items]
+
+    def bench_resolve_type_cold(self):
+        middleware = self.processor.middleware.middlewares[0]
+        items = self.__abstract_items()
+
+        def resolve_types():
+            middleware.type_cache.clear()
+            return [middleware.resolve_type(item, info) for item, info in items]
+
+        return resolve_types
+
+    def bench_query_warm(self):
+        self.processor.query(self.query)
+        return lambda: self.processor.query(self.query)
+
+    def bench_query_cold(self):
+        def query():
+            plans.invalidate()
+            processor = GraphQLProcessor(self.gateway, schema_path=self.schema_path, response_cache={},
+                                         plan_check_interval=0)
+            return processor.query(self.query)
+
+        return query
+
+
+BENCHMARKS = [
+    ('schema.create_gql_schema', Suite.bench_schema),
+    ('sparql.root_mode', Suite.bench_sparql_root),
+    ('sparql.full', Suite.bench_sparql_full),
+    ('match.types', Suite.bench_match_types),
+    ('match.properties', Suite.bench_match_properties),
+    ('middleware.resolve', Suite.bench_resolve),
+    ('middleware.resolve_type.warm', Suite.bench_resolve_type_warm),
+    ('middleware.resolve_type.cold', Suite.bench_resolve_type_cold),
+    ('query.warm', Suite.bench_query_warm),
+    ('query.cold', Suite.bench_query_cold),
+]
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+
+def run(config, names=None, rounds=5, min_time=0.05):
+    suite = Suite(config)
+    results = {}
+    try:
+        for name, bench in BENCHMARKS:
+            if names and not any(n in name for n in names):
+                continue
+            log.info('Running {}...'.format(name))
+            results[name] = summary(*measure(bench(suite), rounds=rounds, min_time=min_time))
+    finally:
+        suite.close()
+
+    return {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results
+    }
+
+
+def compare(report, baseline):
+    """
+    Lines comparing the median time of each benchmark with the one of a baseline report.
+    """
+    lines = []
+    for name, _ in BENCHMARKS:
+        result = report['results'].get(name, None)
+        if result is None:
+            continue
+        line = u'{:<32} {:>12.3f} ms'.format(name, result['median'] * 1000)
+        base = baseline.get('results', {}).get(name, None)
+        if base is not None and base['median']:
+            line += u' {:>12.3f} ms {:>+8.1f}%'.format(base['median'] * 1000,
+                                                      (result['median'] / base['median'] - 1) * 100)
+        lines.append(line)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the agora-graphql benchmarks against a synthetic, '
+                                                 'in-memory fountain and ecosystem.')
+    parser.add_argument('-o', '--output', help='File to write the results to (JSON)')
+    parser.add_argument('-c', '--compare', help='Results file of a previous run to compare with')
+    parser.add_argument('-k', '--filter', action='append', help='Run only benchmarks whose name contains this')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05, help='Minimum duration of a round (seconds)')
+    parser.add_argument('--types', type=int, default=20)
+    parser.add_argument('--attributes', type=int, default=4)
+    parser.add_argument('--unions', type=int, default=2)
+    parser.add_argument('--interfaces', type=int, default=2)
+    parser.add_argument('--size', type=int, default=20, help='Root resources per type')
+    parser.add_argument('--fan-out', type=int, default=2, help='Objects per resource link')
+    parser.add_argument('--depth', type=int, default=2, help='Nesting depth of the benchmark query')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('agora').setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+
+    config = {k: getattr(args, k) for k in ('types', 'attributes', 'unions', 'interfaces', 'size', 'fan_out',
+                                             'depth')}
+    report = run(config, names=args.filter, rounds=args.rounds, min_time=args.min_time)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    for line in compare(report, baseline):
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Copyright (C) 2018 Fernando Serena.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+            http://www.apache.org/licenses/LICENSE-2.0
+
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=#
+"""
+import re
+
+from rdflib import Graph, URIRef, Literal, RDF, Namespace
+
+__author__ = 'Fernando Serena'
+
+BASE = 'http://bench.example.org/'
+EX = Namespace(BASE + 'vocab#')
+PREFIXES = {'ex': URIRef(unicode(EX)), 'xsd': URIRef('http://www.w3.org/2001/XMLSchema#'),
+            'rdf': URIRef(unicode(RDF))}
+
+ROOT_TYPE = re.compile(r'<{}> <([^>]+)>'.format(re.escape(unicode(RDF.type))))
+
+
+def node(i):
+    return 'ex:Node{}'.format(i)
+
+
+def local(t):
+    return t.split(':')[1]
+
+
+class SyntheticFountain(object):
+    """
+    In-memory fountain of a configurable size. Every Node type has some data attributes and a link to the
+    next one (so that queries can nest); the first ones also link to a union of two other nodes and to an
+    interface (a Shape type and two subtypes of it).
+    """
+
+    def __init__(self, types=20, attributes=4, unions=2, interfaces=2):
+        types = max(types, 3)
+        self.__types = {}
+        self.__properties = {}
+
+        for i in range(types):
+            self.__add_type(node(i))
+        for i in range(types):
+            for j in range(attributes):
+                self.__add_attribute(node(i), 'ex:node{}Attr{}'.format(i, j))
+            self.__add_link(node(i), 'ex:node{}Next'.format(i), [node((i + 1) % types)])
+
+        for k in range(unions):
+            i = k % types
+            self.__add_link(node(i), 'ex:node{}Either{}'.format(i, k),
+                            [node((i + 1) % types), node((i + 2) % types)])
+
+        for k in range(interfaces):
+            base = 'ex:Shape{}'.format(k)
+            subs = ['ex:Square{}'.format(k), 'ex:Circle{}'.format(k)]
+            self.__add_type(base, sub=subs)
+            for j in range(attributes):
+                self.__add_attribute(base, 'ex:shape{}Attr{}'.format(k, j))
+            for sub in subs:
+                self.__add_type(sub, sup=[base], properties=list(self.__types[base]['properties']))
+            i = k % types
+            self.__add_link(node(i), 'ex:node{}Shape{}'.format(i, k), [base] + subs)
+
+        self.types = sorted(self.__types)
+        self.properties = sorted(self.__properties)
+        self.prefixes = PREFIXES
+
+    def __add_type(self, t, sup=(), sub=(), properties=None):
+        self.__types[t] = {'properties': properties if properties is not None else [], 'refs': [],
+                           'super': list(sup), 'sub': list(sub)}
+
+    def __add_attribute(self, t, p):
+        self.__types[t]['properties'].append(p)
+        self.__properties[p] = {'type': 'data', 'range': ['xsd:string'], 'domain': [t]}
+
+    def __add_link(self, t, p, p_range):
+        self.__types[t]['properties'].append(p)
+        self.__properties[p] = {'type': 'object', 'range': list(p_range), 'domain': [t]}
+        for r in p_range:
+            self.__types[r]['refs'].append(p)
+
+    def get_type(self, t):
+        return self.__types[t]
+
+    def get_property(self, p):
+        return self.__properties[p]
+
+    def query(self, type_index=0, depth=2):
+        """
+        GraphQL query that selects every attribute of Node{type_index} and follows its links down to
+        the given depth, with inline fragments for union members.
+        """
+
+        def selection(t, level):
+            lines = []
+            for p in self.__types[t]['properties']:
+                p_dict = self.__properties[p]
+                if p_dict['type'] == 'data':
+                    lines.append(local(p))
+                elif level < depth:
+                    p_range = p_dict['range']
+                    if len(p_range) > 1 and not any(self.__types[r]['sub'] for r in p_range):
+                        fragments = ['... on {} {}'.format(local(r), selection(r, level + 1)) for r in p_range]
+                        lines.append('{} {{ {} }}'.format(local(p), ' '.join(fragments)))
+                    else:
+                        lines.append('{} {}'.format(local(p), selection(p_range[0], level + 1)))
+            return '{{ {} }}'.format(' '.join(lines))
+
+        t = node(type_index)
+        return '{{ {} {} }}'.format(local(t), selection(t, 0))
+
+
+class Ecosystem(object):
+    def __init__(self):
+        self.roots = [object()]
+
+
+class TED(object):
+    def __init__(self):
+        self.ecosystem = Ecosystem()
+
+
+class Agora(object):
+    def __init__(self, fountain):
+        self.fountain = fountain
+
+
+class SyntheticDataGateway(object):
+    """
+    Stand-in for a data gateway: seeds are the first 'size' resources of the queried type, and resource
+    graphs are generated on demand, each one linking to 'fan_out' resources of every property range.
+    """
+
+    def __init__(self, fountain, size, fan_out):
+        self.fountain = fountain
+        self.size = size
+        self.fan_out = fan_out
+
+    def uri(self, t, i):
+        return URIRef(u'{}{}/{}'.format(BASE, local(t).lower(), i % self.size))
+
+    def fragment(self, q, **kwargs):
+        def gen():
+            m = ROOT_TYPE.search(q)
+            if m is not None:
+                t = 'ex:' + m.group(1).split('#')[-1]
+                for i in range(self.size):
+                    yield None, self.uri(t, i), RDF.type, URIRef(m.group(1))
+
+        return {'generator': gen()}
+
+    def loader(self, uri, format):
+        type_name, i = uri[len(BASE):].split('/')
+        i = int(i)
+        types = {local(t).lower(): t for t in self.fountain.types}
+        t = types[type_name]
+
+        g = Graph()
+        g.bind('ex', EX)
+        u = URIRef(uri)
+        for ty in [t] + self.fountain.get_type(t)['super']:
+            g.add((u, RDF.type, EX[local(ty)]))
+        for p in self.fountain.get_type(t)['properties']:
+            p_dict = self.fountain.get_property(p)
+            pred = EX[local(p)]
+            if p_dict['type'] == 'data':
+                g.add((u, pred, Literal(u'{} {}'.format(local(p), i))))
+            else:
+                concrete = [r for r in p_dict['range'] if not self.fountain.get_type(r)['sub']]
+                for j in range(self.fan_out):
+                    target = concrete[j % len(concrete)]
+                    g.add((u, pred, self.uri(target, i * self.fan_out + j)))
+        return g, {}
+
+
+class SyntheticGateway(object):
+    """
+    Offline gateway over a SyntheticFountain.
+    """
+    data_cache = None
+
+    def __init__(self, fountain, size=20, fan_out=2):
+        self.agora = Agora(fountain)
+        self.size = size
+        self.fan_out = fan_out
+
+    def discover(self, q, strict=False, lazy=True):
+        return TED()
+
+    def data(self, q, **kwargs):
+        return SyntheticDataGateway(self.agora.fountain, self.size, self.fan_out)
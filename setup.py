@@ -35,9 +35,10 @@ setup(
     keywords=["agora", "discovery", "linked data", "graphql"],
     url=metadata['github'],
     download_url="https://github.com/fserena/agora-graphql/tarball/{}".format(metadata['version']),
-    packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+    packages=find_packages(exclude=['ez_setup', 'examples', 'tests', 'benchmarks']),
     install_requires=['requests', 'futures', 'python-dateutil', 'graphql-core', 'Flask-Cors',
-                      'Flask-GraphQL>=2.0', 'agora-gw', 'agora-wot', 'agora-py', 'shortuuid', 'expiringdict'],
+                      'Flask-GraphQL>=2.0', 'agora-gw', 'agora-wot', 'agora-py'],
+    extras_require={'redis': ['redis']},
     classifiers=[],
     include_package_data=True,
     package_dir={'agora_graphql': 'agora_graphql'},